@@ -3,10 +3,15 @@ API Key Authentication Middleware
 Maps generated sk-xxx API keys to ChatGPT access tokens
 """
 import json
+import os
 import sys
+import threading
+import time
 from pathlib import Path
 from typing import Optional
 
+from utils.Logger import logger
+
 # Configuration - Use exe-relative paths when bundled
 def get_config_dir():
     """Get the appropriate config directory based on execution context"""
@@ -21,37 +26,103 @@ CONFIG_DIR = get_config_dir()
 APIKEYS_FILE = CONFIG_DIR / "apikeys.json"
 TOKENS_FILE = CONFIG_DIR / "tokens.json"
 
+# Files written by /admin/sync/* in the server's working directory
+SYNC_APIKEYS_FILE = Path("apikeys.json")
+SYNC_TOKENS_FILE = Path("tokens.json")
+
+
+def load_json_dict(path: Path) -> dict:
+    if path.exists():
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+                if isinstance(data, dict):
+                    return data
+        except (json.JSONDecodeError, Exception):
+            pass
+    return {}
+
+
+def file_signature(path: Path):
+    try:
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+
+class APIKeyResolver:
+    """
+    Resolves sk-xxx API keys to ChatGPT tokens from an in-memory index
+
+    The index is rebuilt only when one of the source files changes (inode, mtime or
+    size), checked at most once per check_interval, or when reload() is called.
+    Sources are (apikeys file, tokens file) pairs; the first one that maps a key wins.
+    """
+
+    def __init__(self, sources, check_interval=1.0):
+        self.sources = sources
+        self.check_interval = check_interval
+        self.index = {}
+        self.signature = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def files(self):
+        return [path for pair in self.sources for path in pair]
+
+    def reload(self):
+        with self.lock:
+            signature = tuple(file_signature(path) for path in self.files())
+            index = {}
+            apikeys_count = 0
+            for apikeys_file, tokens_file in self.sources:
+                apikeys = load_json_dict(apikeys_file)
+                tokens = load_json_dict(tokens_file)
+                apikeys_count += len(apikeys)
+                for name, data in apikeys.items():
+                    if not isinstance(data, dict) or not data.get('key') or data['key'] in index:
+                        continue
+                    token_name = data.get('token_name', 'auto')
+                    if token_name in tokens:
+                        index[data['key']] = (name, token_name, tokens[token_name])
+                    elif token_name == 'auto' and tokens:
+                        index[data['key']] = (name, token_name, next(iter(tokens.values())))
+            self.index = index
+            self.signature = signature
+            self.checked = time.monotonic()
+        logger.info(f"📁 Loaded {apikeys_count} API keys, {len(index)} mapped to tokens")
+
+    def check(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        if tuple(file_signature(path) for path in self.files()) != self.signature:
+            self.reload()
+
+    def lookup(self, api_key: str):
+        """Returns (api key name, token name, token) or None"""
+        self.check()
+        return self.index.get(api_key)
+
+    def resolve(self, api_key: str) -> str:
+        """Returns the mapped token, or api_key itself when it is not a known key"""
+        if not api_key or not api_key.startswith("sk-"):
+            return api_key
+        entry = self.lookup(api_key)
+        return entry[2] if entry else api_key
+
+
+# Shared by APIKeyMapperMiddleware and APIKeyAuth
+apikey_resolver = APIKeyResolver([(SYNC_APIKEYS_FILE, SYNC_TOKENS_FILE), (APIKEYS_FILE, TOKENS_FILE)])
+
 
 class APIKeyAuth:
     """Handles API key authentication and mapping"""
 
-    def __init__(self):
-        self.apikeys = self.load_apikeys()
-        self.tokens = self.load_tokens()
-
-    def load_apikeys(self) -> dict:
-        """Load generated API keys"""
-        if APIKEYS_FILE.exists():
-            try:
-                with open(APIKEYS_FILE, 'r') as f:
-                    data = json.load(f)
-                    if isinstance(data, dict):
-                        return data
-            except (json.JSONDecodeError, Exception):
-                pass
-        return {}
-
-    def load_tokens(self) -> dict:
-        """Load ChatGPT tokens"""
-        if TOKENS_FILE.exists():
-            try:
-                with open(TOKENS_FILE, 'r') as f:
-                    data = json.load(f)
-                    if isinstance(data, dict):
-                        return data
-            except (json.JSONDecodeError, Exception):
-                pass
-        return {}
+    def __init__(self, resolver: APIKeyResolver):
+        self.resolver = resolver
 
     def validate_and_map_apikey(self, api_key: str) -> Optional[str]:
         """
@@ -61,32 +132,11 @@ class APIKeyAuth:
             api_key: The API key to validate (sk-xxx format)
 
         Returns:
-            The ChatGPT access token if valid, None otherwise
+            The ChatGPT access token if the key is known, otherwise api_key unchanged
+            (direct ChatGPT tokens and unknown keys are left for the server to handle)
         """
-        # Reload files in case they were updated
-        self.apikeys = self.load_apikeys()
-        self.tokens = self.load_tokens()
-
-        # If it doesn't start with sk-, it's probably a direct ChatGPT token
-        if not api_key.startswith("sk-"):
-            return api_key
-
-        # Search for the API key in our generated keys
-        for name, data in self.apikeys.items():
-            if data.get('key') == api_key:
-                # Found the API key, now get the associated token
-                token_name = data.get('token_name', 'auto')
-
-                if token_name in self.tokens:
-                    # Return the ChatGPT token
-                    return self.tokens[token_name]
-                elif token_name == 'auto' and self.tokens:
-                    # Return first available token
-                    return list(self.tokens.values())[0]
-
-        # API key not found, return original (let server handle it)
-        return api_key
+        return self.resolver.resolve(api_key)
 
 
 # Global instance
-apikey_auth = APIKeyAuth()
+apikey_auth = APIKeyAuth(apikey_resolver)
@@ -11,8 +11,15 @@ import utils.globals as globals
 from app import app, templates, security_scheme
 from chatgpt.ChatService import ChatService
 from chatgpt.authorization import refresh_all_tokens
+from chatgpt.powSolver import pow_solver
+from chatgpt.refreshToken import token_refresher, bulk_refresher
+from chatgpt.sharedState import shared_state_sync
+from chatgpt.tokenScheduler import token_scheduler
+from utils.Client import session_pool
 from utils.Logger import logger
-from utils.config import api_prefix, scheduled_refresh
+from utils.config import api_prefix, scheduled_refresh, refresh_window, authorization_list
+from utils.metrics import metrics
+from utils.store import json_store
 from utils.retry import async_retry
 from api.apikey_auth import apikey_auth
 
@@ -21,13 +28,25 @@ scheduler = AsyncIOScheduler()
 
 @app.on_event("startup")
 async def app_start():
+    shared_state_sync.start()
+    token_refresher.start()
     if scheduled_refresh:
         scheduler.add_job(id='refresh', func=refresh_all_tokens, trigger='cron', hour=3, minute=0, day='*/2',
-                          kwargs={'force_refresh': True})
+                          kwargs={'force_refresh': True, 'window': refresh_window})
         scheduler.start()
         asyncio.get_event_loop().call_later(0, lambda: asyncio.create_task(refresh_all_tokens(force_refresh=False)))
 
 
+@app.on_event("shutdown")
+async def app_stop():
+    token_refresher.stop()
+    pow_solver.shutdown()
+    await session_pool.close()
+    await shared_state_sync.stop()
+    json_store.close()
+    globals.state.close()
+
+
 async def to_send_conversation(request_data, req_token):
     chat_service = ChatService(req_token)
     try:
@@ -45,8 +64,12 @@ async def to_send_conversation(request_data, req_token):
 
 async def process(request_data, req_token):
     chat_service = await to_send_conversation(request_data, req_token)
-    await chat_service.prepare_send_conversation()
-    res = await chat_service.send_conversation()
+    try:
+        await chat_service.prepare_send_conversation()
+        res = await chat_service.send_conversation()
+    except Exception:
+        await chat_service.close_client()
+        raise
     return chat_service, res
 
 
@@ -84,7 +107,7 @@ async def send_conversation(request: Request, credentials: HTTPAuthorizationCred
 
 @app.get(f"{api_prefix}/tokens" if api_prefix else "/tokens", response_class=HTMLResponse)
 async def upload_html(request: Request):
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(token_scheduler)
     return templates.TemplateResponse("tokens.html",
                                       {"request": request, "api_prefix": api_prefix, "tokens_count": tokens_count})
 
@@ -95,10 +118,11 @@ async def upload_post(text: str = Form(...)):
     for line in lines:
         if line.strip() and not line.startswith("#"):
             globals.token_list.append(line.strip())
-            with open(globals.TOKENS_FILE, "a", encoding="utf-8") as f:
-                f.write(line.strip() + "\n")
+            if line.strip() not in globals.error_token_list:
+                token_scheduler.add(line.strip())
+            globals.state.add_token(line.strip())
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(token_scheduler)
     return {"status": "success", "tokens_count": tokens_count}
 
 
@@ -106,10 +130,10 @@ async def upload_post(text: str = Form(...)):
 async def upload_post():
     globals.token_list.clear()
     globals.error_token_list.clear()
-    with open(globals.TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
+    token_scheduler.reset(globals.token_list, globals.error_token_list)
+    globals.state.clear_tokens()
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(token_scheduler)
     return {"status": "success", "tokens_count": tokens_count}
 
 
@@ -123,8 +147,24 @@ async def error_tokens():
 async def add_token(token: str):
     if token.strip() and not token.startswith("#"):
         globals.token_list.append(token.strip())
-        with open(globals.TOKENS_FILE, "a", encoding="utf-8") as f:
-            f.write(token.strip() + "\n")
+        if token.strip() not in globals.error_token_list:
+            token_scheduler.add(token.strip())
+        globals.state.add_token(token.strip())
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(token_scheduler)
     return {"status": "success", "tokens_count": tokens_count}
+
+
+@app.get(f"{api_prefix}/tokens/refresh/status" if api_prefix else "/tokens/refresh/status")
+async def refresh_status():
+    return {"status": "success", "refresh": bulk_refresher.get_status()}
+
+
+@app.get(f"{api_prefix}/metrics" if api_prefix else "/metrics")
+async def get_metrics(credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
+    # Only served when AUTHORIZATION is configured, and only to those keys
+    if not authorization_list:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials.credentials not in authorization_list:
+        raise HTTPException(status_code=401, detail="Invalid authorization")
+    return metrics.snapshot()
@@ -1,11 +1,30 @@
+import asyncio
+import hashlib
 import io
+import re
+import struct
+import tempfile
 
 import pybase64
-from PIL import Image
+from curl_cffi import CurlError
+from curl_cffi.curl import CURLPAUSE_CONT, CURLPAUSE_RECV
+from PIL import Image, ImageOps
 
-from utils.Client import Client
+from api.tokens import effective_image_size
+from utils.Client import session_pool
+from utils.Logger import logger
 from utils.config import export_proxy_url, cf_file_url
 
+FILE_CHUNK_SIZE = 256 * 1024
+# Enough for image headers behind large EXIF/ICC segments
+FILE_HEAD_SIZE = 256 * 1024
+# Downloads without a usable Content-Length stay in memory up to this size, then go to disk
+FILE_SPOOL_SIZE = 4 * 1024 * 1024
+# Chunks a streamed download may run ahead of its upload before the transfer is paused
+FILE_QUEUE_SIZE = 64
+BASE64_STEP = FILE_CHUNK_SIZE // 3 * 4
+BASE64_CLEAN = re.compile(r'[^A-Za-z0-9+/=]')
+
 
 async def get_file_content(url):
     if url.startswith("data:"):
@@ -13,7 +32,7 @@ async def get_file_content(url):
         file_content = pybase64.b64decode(base64_data)
         return file_content, mime_type
     else:
-        client = Client()
+        client = session_pool.client()
         try:
             if cf_file_url:
                 body = {"file_url": url}
@@ -30,6 +49,214 @@ async def get_file_content(url):
             del client
 
 
+class FileStream:
+    """A file that is uploaded in chunks instead of being held in memory.
+
+    size is known before the upload starts and head holds the first bytes for
+    sniffing the format. sha256 is set once every byte has been read, which for
+    data URLs and spooled downloads happens before the upload. chunks() can be
+    consumed once.
+    """
+
+    def __init__(self, mime_type, size, head):
+        self.mime_type = mime_type
+        self.size = size
+        self.head = head
+        self.sha256 = None
+
+    async def chunks(self):
+        yield self.head
+
+    async def close(self):
+        pass
+
+
+class BytesStream(FileStream):
+    def __init__(self, file_content, mime_type):
+        super().__init__(mime_type, len(file_content), file_content)
+        self.sha256 = hashlib.sha256(file_content).hexdigest()
+
+
+class DataURLStream(FileStream):
+    """Decodes the base64 payload of a data URL a slice at a time.
+
+    The URL is already a str from the request body, so slices of it are decoded
+    directly and the decoded file never exists in one piece.
+    """
+
+    def __init__(self, url, start, mime_type):
+        self.url = url
+        self.start = start
+        padding = url.count("=", len(url) - 2)
+        size = (len(url) - start) // 4 * 3 - padding
+        super().__init__(mime_type, size, pybase64.b64decode(url[start:start + FILE_HEAD_SIZE // 3 * 4]))
+
+    def decode(self):
+        for offset in range(self.start, len(self.url), BASE64_STEP):
+            yield pybase64.b64decode(self.url[offset:offset + BASE64_STEP])
+
+    def hash(self):
+        digest = hashlib.sha256()
+        for chunk in self.decode():
+            digest.update(chunk)
+        self.sha256 = digest.hexdigest()
+
+    async def chunks(self):
+        for chunk in self.decode():
+            yield chunk
+
+
+class RemoteStream(FileStream):
+    """Pipes a streamed download into the upload through a bounded queue.
+
+    A reader task moves the download into a queue of at most FILE_QUEUE_SIZE chunks
+    and pauses the transfer while the queue is full, so a source faster than the
+    upload waits on the network instead of piling up in memory. Without a usable
+    Content-Length the download is first spooled to a temporary file (in memory up
+    to FILE_SPOOL_SIZE), written in batches on a worker thread, to learn its size.
+    """
+
+    def __init__(self, client, response, mime_type, size, head, rest):
+        super().__init__(mime_type, size, head)
+        self.client = client
+        self.response = response
+        self.queue = asyncio.Queue(FILE_QUEUE_SIZE)
+        self.reader = asyncio.create_task(self.read(rest))
+        self.spool = None
+
+    @classmethod
+    async def open(cls, client, response, mime_type):
+        rest = response.aiter_content()
+        head = bytearray()
+        async for chunk in rest:
+            head += chunk
+            if len(head) >= FILE_HEAD_SIZE:
+                break
+        head = bytes(head)
+
+        length = response.headers.get('Content-Length', '')
+        encoding = response.headers.get('Content-Encoding', 'identity')
+        size = int(length) if length.isdigit() and encoding == 'identity' else None
+        stream = cls(client, response, mime_type, size, head, rest)
+        if size is None:
+            try:
+                await stream.spool_all()
+            except BaseException:
+                await stream.close()
+                raise
+        return stream
+
+    def pause(self, action):
+        try:
+            self.response.curl.pause(action)
+        except CurlError:
+            # The transfer has already finished, there is nothing left to hold back
+            pass
+
+    async def read(self, rest):
+        try:
+            async for chunk in rest:
+                if self.queue.full():
+                    self.pause(CURLPAUSE_RECV)
+                    await self.queue.put(chunk)
+                    self.pause(CURLPAUSE_CONT)
+                else:
+                    self.queue.put_nowait(chunk)
+            await self.queue.put(None)
+        except Exception as e:
+            await self.queue.put(e)
+
+    async def next_chunk(self):
+        chunk = await self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    async def spool_all(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=FILE_SPOOL_SIZE)
+        digest = hashlib.sha256()
+        batch = bytearray(self.head)
+        size = 0
+        while True:
+            chunk = await self.next_chunk()
+            if chunk is not None:
+                batch += chunk
+                if len(batch) < FILE_CHUNK_SIZE:
+                    continue
+            await asyncio.to_thread(self.write_batch, digest, batch)
+            size += len(batch)
+            batch = bytearray()
+            if chunk is None:
+                break
+        self.size = size
+        self.sha256 = digest.hexdigest()
+
+    def write_batch(self, digest, batch):
+        digest.update(batch)
+        self.spool.write(batch)
+
+    async def chunks(self):
+        if self.spool is not None:
+            await asyncio.to_thread(self.spool.seek, 0)
+            while chunk := await asyncio.to_thread(self.spool.read, FILE_CHUNK_SIZE):
+                yield chunk
+            return
+        digest = hashlib.sha256(self.head)
+        yield self.head
+        while (chunk := await self.next_chunk()) is not None:
+            digest.update(chunk)
+            yield chunk
+        self.sha256 = digest.hexdigest()
+
+    async def close(self):
+        self.reader.cancel()
+        # Stop the download if the upload gave up before reading all of it, a paused
+        # transfer only notices once it is resumed
+        quit_now = getattr(self.response, "quit_now", None)
+        if quit_now is not None:
+            quit_now.set()
+        self.pause(CURLPAUSE_CONT)
+        if self.spool is not None:
+            await asyncio.to_thread(self.spool.close)
+        await self.client.close()
+
+
+async def get_file_stream(url):
+    """Like get_file_content, but returns a FileStream (or None) for streaming uploads."""
+    if url.startswith("data:"):
+        start = url.find(',') + 1
+        mime_type = url[5:start].split(';')[0].split(',')[0]
+        if (len(url) - start) % 4 or BASE64_CLEAN.search(url, start):
+            file_content, mime_type = await get_file_content(url)
+            return BytesStream(file_content, mime_type)
+        stream = DataURLStream(url, start, mime_type)
+        if stream.size > 1024 * 1024:
+            await asyncio.to_thread(stream.hash)
+        else:
+            stream.hash()
+        return stream
+
+    client = session_pool.client()
+    r = None
+    try:
+        if cf_file_url:
+            body = {"file_url": url}
+            r = await client.post(cf_file_url, timeout=60, json=body, stream=True)
+        else:
+            r = await client.get(url, proxy=export_proxy_url, timeout=60, stream=True)
+        if r.status_code != 200:
+            await r.aclose()
+            await client.close()
+            return None
+        mime_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+        return await RemoteStream.open(client, r, mime_type)
+    except BaseException:
+        if getattr(r, "quit_now", None) is not None:
+            r.quit_now.set()
+        await client.close()
+        raise
+
+
 async def determine_file_use_case(mime_type):
     multimodal_types = ["image/jpeg", "image/webp", "image/png", "image/gif"]
     my_files_types = ["text/x-php", "application/msword", "text/x-c", "text/html",
@@ -48,11 +275,86 @@ async def determine_file_use_case(mime_type):
         return "ace_upload"
 
 
+def probe_image_size(data):
+    """Reads width and height from a PNG, GIF, WebP or JPEG header, or returns None."""
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', data[6:10])
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        chunk = data[12:16]
+        if chunk == b'VP8 ' and len(data) >= 30:
+            width, height = struct.unpack('<HH', data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L' and len(data) >= 25:
+            bits = int.from_bytes(data[21:25], 'little')
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X' and len(data) >= 30:
+            return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+        return None
+    if data[:2] == b'\xff\xd8':
+        offset = 2
+        while offset + 9 <= len(data):
+            if data[offset] != 0xFF:
+                return None
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                offset += 2
+                continue
+            # Start-of-frame markers carry the dimensions; C4, C8 and CC are other tables
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+                return width, height
+            offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
 async def get_image_size(file_content):
+    size = probe_image_size(file_content)
+    if size and all(size):
+        return size
     with Image.open(io.BytesIO(file_content)) as img:
         return img.width, img.height
 
 
+def resize_image(file_content):
+    with Image.open(io.BytesIO(file_content)) as img:
+        # Phone cameras write multi-picture JPEGs (MPO), frame 0 is the photo itself
+        image_format = "JPEG" if img.format == "MPO" else img.format
+        if image_format != "JPEG" and getattr(img, "is_animated", False):
+            return file_content
+        img = ImageOps.exif_transpose(img)
+        size = effective_image_size(img.width, img.height)
+        if size == (img.width, img.height):
+            return file_content
+        img = img.resize(size, Image.LANCZOS)
+        output = io.BytesIO()
+        if image_format in ("JPEG", "WEBP"):
+            img.save(output, format=image_format, quality=90)
+        else:
+            img.save(output, format=image_format)
+    resized = output.getvalue()
+    return resized if len(resized) < len(file_content) else file_content
+
+
+async def downscale_image(file_content):
+    """Resizes an image to the resolution the upstream uses, on a worker thread.
+
+    Images already within it (judged from the header alone) are returned as they are.
+    """
+    size = probe_image_size(file_content)
+    if size and effective_image_size(*size) == tuple(size):
+        return file_content
+    try:
+        return await asyncio.to_thread(resize_image, file_content)
+    except Exception as e:
+        logger.error(f"Failed to downscale image: {e}")
+        return file_content
+
+
 async def get_file_extension(mime_type):
     extension_mapping = {
         "image/jpeg": ".jpg",
@@ -8,6 +8,9 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Dict
 
+import utils.globals as globals
+from api.apikey_auth import apikey_resolver
+
 router = APIRouter()
 
 # File paths
@@ -42,12 +45,11 @@ async def sync_tokens(request: TokensSyncRequest):
         # Save to tokens.json
         with open(TOKENS_FILE, 'w') as f:
             json.dump(existing_tokens, f, indent=2)
+        apikey_resolver.reload()
         
-        # Also append to data/token.txt
-        DATA_TOKEN_FILE.parent.mkdir(exist_ok=True)
-        with open(DATA_TOKEN_FILE, 'a') as f:
-            for token in request.tokens.values():
-                f.write(f"{token}\n")
+        # Also add to the token store (data/token.txt or the state database)
+        for token in request.tokens.values():
+            globals.state.add_token(token)
         
         return {
             "status": "success",
@@ -75,6 +77,7 @@ async def sync_apikeys(request: APIKeysSyncRequest):
         # Save to apikeys.json
         with open(APIKEYS_FILE, 'w') as f:
             json.dump(existing_apikeys, f, indent=2)
+        apikey_resolver.reload()
         
         return {
             "status": "success",
@@ -1,32 +1,32 @@
+import asyncio
+import hashlib
 import math
+from collections import OrderedDict
+from functools import lru_cache
 
 import tiktoken
 
+from utils.config import token_cache_size, token_thread_threshold
+
+
+def effective_image_size(width, height):
+    """Resolution the upstream actually looks at: within 2048x2048, shortest side at most 768."""
+    max_dimension = max(width, height)
+    if max_dimension > 2048:
+        scale_factor = 2048 / max_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+    min_dimension = min(width, height)
+    if min_dimension > 768:
+        scale_factor = 768 / min_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+    return width, height
+
 
 async def calculate_image_tokens(width, height, detail):
     if detail == "low":
         return 85
     else:
-        max_dimension = max(width, height)
-        if max_dimension > 2048:
-            scale_factor = 2048 / max_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
-        min_dimension = min(width, height)
-        if min_dimension > 768:
-            scale_factor = 768 / min_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
+        width, height = effective_image_size(width, height)
         num_masks_w = math.ceil(width / 512)
         num_masks_h = math.ceil(height / 512)
         total_masks = num_masks_w * num_masks_h
@@ -37,50 +37,186 @@ async def calculate_image_tokens(width, height, detail):
         return total_tokens
 
 
-async def num_tokens_from_messages(messages, model=''):
+@lru_cache(maxsize=None)
+def get_encoding(model=None):
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenCountCache:
+    """LRU of token counts per text, keyed by encoding name and a digest of the text.
+
+    Clients resend the whole history on every turn, so all but the newest
+    messages are found here instead of being encoded again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = OrderedDict()
+
+    def key(self, encoding, text):
+        return encoding.name, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+    def get(self, key):
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts.move_to_end(key)
+        return count
+
+    def put(self, key, count):
+        if self.size <= 0:
+            return
+        self.counts[key] = count
+        self.counts.move_to_end(key)
+        while len(self.counts) > self.size:
+            self.counts.popitem(last=False)
+
+
+token_count_cache = TokenCountCache(token_cache_size)
+
+
+async def count_texts(encoding, texts):
+    """Returns the number of tokens in each text, encoding only cache misses.
+
+    When the misses add up to more than TOKEN_THREAD_THRESHOLD characters they
+    are encoded in a worker thread so long prompts don't stall the event loop.
+    """
+    counts = [0] * len(texts)
+    misses = []
+    for index, text in enumerate(texts):
+        key = token_count_cache.key(encoding, text)
+        count = token_count_cache.get(key)
+        if count is None:
+            misses.append((index, key, text))
+        else:
+            counts[index] = count
+
+    def encode_misses():
+        return [len(encoding.encode(text)) for _, _, text in misses]
+
+    if misses:
+        if sum(len(text) for _, _, text in misses) > token_thread_threshold:
+            missed = await asyncio.to_thread(encode_misses)
+        else:
+            missed = encode_misses()
+        for (index, key, _), count in zip(misses, missed):
+            token_count_cache.put(key, count)
+            counts[index] = count
+    return counts
+
+
+async def encode_content(encoding, content):
+    if len(content) > token_thread_threshold:
+        return await asyncio.to_thread(encoding.encode, content)
+    return encoding.encode(content)
+
+
+async def num_tokens_from_messages(messages, model=''):
+    encoding = get_encoding(model)
     if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4
     else:
         tokens_per_message = 3
-    num_tokens = 0
+    texts = []
     for message in messages:
-        num_tokens += tokens_per_message
         for key, value in message.items():
             if isinstance(value, list):
                 for item in value:
                     if item.get("type") == "text":
-                        num_tokens += len(encoding.encode(item.get("text")))
+                        texts.append(item.get("text"))
                     if item.get("type") == "image_url":
                         pass
             else:
-                num_tokens += len(encoding.encode(value))
+                texts.append(value)
+    num_tokens = tokens_per_message * len(messages) + sum(await count_texts(encoding, texts))
     num_tokens += 3
     return num_tokens
 
 
 async def num_tokens_from_content(content, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
-    len_encoded_content = len(encoded_content)
-    return len_encoded_content
+    encoding = get_encoding(model)
+    return (await count_texts(encoding, [content]))[0]
 
 
 async def split_tokens_from_content(content, max_tokens, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
+    encoding = get_encoding(model)
+    encoded_content = await encode_content(encoding, content)
     len_encoded_content = len(encoded_content)
     if len_encoded_content >= max_tokens:
         content = encoding.decode(encoded_content[:max_tokens])
         return content, max_tokens, "length"
     else:
         return content, len_encoded_content, "stop"
+
+
+class TokenCounter:
+    """Counts completion tokens as the text arrives, encoding each piece once.
+
+    BPE tokens never cross a pre-tokenizer split, and a space that follows a
+    non-space character always starts a new one, so feed encodes and returns the
+    text up to the last such space and carries the rest over; flush releases the
+    carry at the end. Text without spaces (e.g. CJK) is committed by tokens once
+    the carry grows past carry_limit, keeping the last few tokens back. With
+    max_tokens set, only the text that fits is returned and finished is set.
+    """
+
+    carry_limit = 32
+    carry_tokens = 4
+
+    def __init__(self, model=None, max_tokens=None):
+        self.encoding = get_encoding(model)
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.carry = ""
+        self.finished = False
+
+    @property
+    def count(self):
+        if not self.carry:
+            return self.tokens
+        return self.tokens + len(self.encoding.encode(self.carry))
+
+    def feed(self, text):
+        if self.finished or not text:
+            return ""
+        pending = self.carry + text
+        index = pending.rfind(" ")
+        while index > 0 and pending[index - 1].isspace():
+            index = pending.rfind(" ", 0, index)
+        if index > 0:
+            self.carry = pending[index:]
+            return self.commit(self.encoding.encode(pending[:index]), pending[:index])
+        self.carry = pending
+        if len(pending) <= self.carry_limit:
+            return ""
+
+        # No safe split in sight: keep the last few tokens back, cut on a character boundary
+        tokens = self.encoding.encode(pending)
+        data = pending.encode()
+        keep = len(tokens) - self.carry_tokens
+        size = len(self.encoding.decode_bytes(tokens[:keep]))
+        while keep > 0 and size < len(data) and data[size] & 0xC0 == 0x80:
+            keep -= 1
+            size = len(self.encoding.decode_bytes(tokens[:keep]))
+        if keep <= 0:
+            return ""
+        self.carry = data[size:].decode()
+        return self.commit(tokens[:keep], data[:size].decode())
+
+    def flush(self):
+        if self.finished or not self.carry:
+            return ""
+        text, self.carry = self.carry, ""
+        return self.commit(self.encoding.encode(text), text)
+
+    def commit(self, tokens, text):
+        if self.max_tokens is None or self.tokens + len(tokens) < self.max_tokens:
+            self.tokens += len(tokens)
+            return text
+        text = self.encoding.decode(tokens[:self.max_tokens - self.tokens])
+        self.tokens = self.max_tokens
+        self.carry = ""
+        self.finished = True
+        return text
@@ -8,7 +8,7 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
 
-from utils.config import enable_gateway, api_prefix
+from utils.config import enable_gateway, api_prefix, workers
 
 warnings.filterwarnings("ignore")
 
@@ -38,19 +38,7 @@ from middleware.apikey_mapper import APIKeyMapperMiddleware
 app.add_middleware(APIKeyMapperMiddleware)
 
 # Add middleware to handle double slashes in URLs
-from starlette.middleware.base import BaseHTTPMiddleware
-
-class DoubleSlashFixMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        # Fix double slashes in path by normalizing
-        if '//' in request.url.path:
-            # Replace multiple slashes with single slash
-            import re
-            fixed_path = re.sub(r'/+', '/', request.url.path)
-            # Update the request scope path
-            request.scope['path'] = fixed_path
-        return await call_next(request)
-
+from middleware.double_slash import DoubleSlashFixMiddleware
 app.add_middleware(DoubleSlashFixMiddleware)
 
 # Handle templates path for both development and PyInstaller bundle
@@ -96,6 +84,10 @@ if enable_gateway:
 
 if __name__ == "__main__":
     import os
+    import multiprocessing
+
+    # The PoW solver pool spawns worker processes, which needs this in frozen builds
+    multiprocessing.freeze_support()
     
     # Get host and port from environment variables
     host = os.getenv("HOST", "0.0.0.0")
@@ -108,14 +100,16 @@ if __name__ == "__main__":
     print(f"Environment: {environment}")
     print(f"Gateway enabled: {enable_gateway}")
     print(f"API prefix: '{api_prefix}'")
+    print(f"Workers: {workers}")
     
     if environment == "production":
         uvicorn.run(
             "app:app", 
             host=host, 
             port=port,
+            workers=workers,
             access_log=True,
             log_level="info"
         )
     else:
-        uvicorn.run("app:app", host=host, port=port)
+        uvicorn.run("app:app", host=host, port=port, workers=workers)
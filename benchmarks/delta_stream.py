@@ -0,0 +1,100 @@
+"""
+Compares the upstream full-part stream (every event carries the whole accumulated
+parts[0]) with the "v1" delta encoding (append ops), replaying both through
+chatgpt.chatFormat.head_process_response and stream_response.
+
+Both recordings describe the same answer, so the OpenAI chunks must match; the
+report shows bytes received and replay time for growing answer lengths.
+
+Run from the repository root: python -m benchmarks.delta_stream
+"""
+import asyncio
+import json
+import logging
+import time
+
+from chatgpt.chatFormat import head_process_response, stream_response
+
+TOKEN_SIZE = 4
+
+
+class FakeService:
+    history_disabled = True
+    prompt_tokens = 0
+
+    async def close_response(self):
+        pass
+
+
+def new_message():
+    return {"id": "msg-1", "author": {"role": "assistant"}, "status": "in_progress", "recipient": "all",
+            "content": {"content_type": "text", "parts": [""]}, "metadata": {"model_slug": "gpt-4o"}}
+
+
+def full_part_stream(text):
+    message = new_message()
+    lines = []
+    for end in range(0, len(text) + TOKEN_SIZE, TOKEN_SIZE):
+        message["content"]["parts"] = [text[:end]]
+        lines.append("data: " + json.dumps({"message": message, "conversation_id": "conv-1"}))
+    message["status"] = "finished_successfully"
+    message["end_turn"] = True
+    lines.append("data: " + json.dumps({"message": message, "conversation_id": "conv-1"}))
+    lines.append("data: [DONE]")
+    return [line.encode() for line in lines]
+
+
+def delta_stream(text):
+    def delta(value):
+        return ["event: delta", "data: " + json.dumps(value), ""]
+
+    lines = ["event: delta_encoding", 'data: "v1"', ""]
+    lines += delta({"p": "", "o": "add", "v": {"message": new_message(), "conversation_id": "conv-1"}, "c": 0})
+    first = True
+    for start in range(0, len(text), TOKEN_SIZE):
+        if first:
+            lines += delta({"p": "/message/content/parts/0", "o": "append", "v": text[start:start + TOKEN_SIZE]})
+            first = False
+        else:
+            lines += delta({"v": text[start:start + TOKEN_SIZE]})
+    lines += delta({"p": "", "o": "patch", "v": [
+        {"p": "/message/status", "o": "replace", "v": "finished_successfully"},
+        {"p": "/message/end_turn", "o": "replace", "v": True},
+    ]})
+    lines.append("data: [DONE]")
+    return [line.encode() for line in lines]
+
+
+async def replay(lines):
+    async def response():
+        for line in lines:
+            yield line
+
+    events, start = await head_process_response(response())
+    assert start
+    return [chunk async for chunk in stream_response(FakeService(), events, "gpt-4o", 10 ** 6)]
+
+
+def strip_ids(chunks):
+    return [json.loads(chunk[6:])["choices"] for chunk in chunks if chunk.startswith("data: {")]
+
+
+def best_of(lines, rounds=3):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        asyncio.run(replay(lines))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    for words in (100, 1000, 4000):
+        text = " ".join(f"word{i}" for i in range(words))
+        full, delta = full_part_stream(text), delta_stream(text)
+        assert strip_ids(asyncio.run(replay(full))) == strip_ids(asyncio.run(replay(delta)))
+        full_bytes, delta_bytes = sum(map(len, full)), sum(map(len, delta))
+        full_time, delta_time = best_of(full), best_of(delta)
+        print(f"{len(text):>7} chars: full-part {full_bytes:>11,} bytes {full_time * 1000:8.1f} ms | "
+              f"v1 {delta_bytes:>9,} bytes {delta_time * 1000:6.1f} ms ({full_time / delta_time:.1f}x)")
@@ -0,0 +1,133 @@
+"""
+Measures streamed chunks/sec through the app's middleware stack, comparing the
+previous BaseHTTPMiddleware versions of DoubleSlashFixMiddleware and
+APIKeyMapperMiddleware with the pure ASGI ones in middleware/.
+
+Both stacks resolve the API key through the same in-memory index, so the
+difference is the per-chunk cost of the middleware layers themselves.
+
+Run from the repository root: python -m benchmarks.middleware_stream
+"""
+import asyncio
+import logging
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from api.apikey_auth import apikey_resolver
+from middleware.apikey_mapper import APIKeyMapperMiddleware
+from middleware.double_slash import DoubleSlashFixMiddleware
+
+CHUNKS = 2000
+REQUESTS = 10
+CHUNK = b'data: {"id":"chatcmpl-bench","object":"chat.completion.chunk","choices":[{"index":0,"delta":{"content":"hello"}}]}\n\n'
+
+
+class LegacyDoubleSlashFixMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        if '//' in request.url.path:
+            import re
+            fixed_path = re.sub(r'/+', '/', request.url.path)
+            request.scope['path'] = fixed_path
+        return await call_next(request)
+
+
+class LegacyAPIKeyMapperMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app):
+        super().__init__(app)
+        self.mapper = APIKeyMapperMiddleware(None)
+
+    async def dispatch(self, request, call_next):
+        auth_header = request.headers.get("authorization", "")
+        if auth_header.startswith("Bearer "):
+            original_token = auth_header[7:]
+            if original_token.startswith("sk-"):
+                mapped_token = self.mapper.map_apikey_to_token(original_token)
+                if mapped_token != original_token:
+                    new_headers = []
+                    for name, value in request.scope["headers"]:
+                        if name.lower() == b"authorization":
+                            new_headers.append((name, f"Bearer {mapped_token}".encode()))
+                        else:
+                            new_headers.append((name, value))
+                    request.scope["headers"] = new_headers
+        return await call_next(request)
+
+
+async def completions(request):
+    assert request.headers["authorization"] == "Bearer mapped-token"
+
+    async def stream():
+        for _ in range(CHUNKS):
+            yield CHUNK
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def build_app(apikey_middleware, double_slash_middleware):
+    app = Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+    app.add_middleware(apikey_middleware)
+    app.add_middleware(double_slash_middleware)
+    return app
+
+
+async def run_request(app):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "//v1/chat/completions", "raw_path": b"//v1/chat/completions",
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 5005),
+        "headers": [(b"authorization", b"Bearer sk-bench"), (b"content-type", b"application/json")],
+    }
+    disconnect = asyncio.Event()
+    chunks = 0
+
+    async def receive():
+        if not hasattr(receive, "sent"):
+            receive.sent = True
+            return {"type": "http.request", "body": b"{}", "more_body": False}
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal chunks
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks += 1
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            disconnect.set()
+
+    await app(scope, receive, send)
+    assert chunks == CHUNKS, chunks
+    return chunks
+
+
+async def bench(app):
+    start = time.perf_counter()
+    chunks = 0
+    for _ in range(REQUESTS):
+        chunks += await run_request(app)
+    return chunks / (time.perf_counter() - start)
+
+
+async def main():
+    # Serve the benchmark key from memory only, without looking at the key files
+    apikey_resolver.index = {"sk-bench": ("bench", "auto", "mapped-token")}
+    apikey_resolver.check_interval = float("inf")
+    apikey_resolver.checked = time.monotonic()
+    legacy_app = build_app(LegacyAPIKeyMapperMiddleware, LegacyDoubleSlashFixMiddleware)
+    asgi_app = build_app(APIKeyMapperMiddleware, DoubleSlashFixMiddleware)
+
+    legacy = asgi = 0.0
+    for _ in range(3):
+        legacy = max(legacy, await bench(legacy_app))
+        asgi = max(asgi, await bench(asgi_app))
+    print(f"BaseHTTPMiddleware: {legacy:,.0f} chunks/s")
+    print(f"pure ASGI:          {asgi:,.0f} chunks/s")
+    print(f"speedup:            {asgi / legacy:.2f}x")
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""
+Compares the incremental PoW engine in chatgpt/proofofWork.py with the previous
+full re-encode loop and checks both return byte-identical answers.
+
+Run from the repository root: python -m benchmarks.pow_engine
+"""
+import hashlib
+import json
+import random
+import time
+
+import pybase64
+
+from chatgpt.proofofWork import generate_answer_range, get_config
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
+
+
+def legacy_generate_answer_range(seed, diff, config, start, end):
+    diff_len = len(diff)
+    seed_encoded = seed.encode()
+    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
+    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
+    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
+
+    target_diff = bytes.fromhex(diff)
+
+    for i in range(start, end):
+        dynamic_json_i = str(i).encode()
+        dynamic_json_j = str(i >> 1).encode()
+        final_json_bytes = static_config_part1 + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3
+        base_encode = pybase64.b64encode(final_json_bytes)
+        hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
+        if hash_value[:diff_len] <= target_diff:
+            return base_encode.decode(), True
+
+    return None, False
+
+
+def check_identical(rounds=200):
+    for _ in range(rounds):
+        config = get_config(USER_AGENT)
+        seed = format(random.random())
+        diff = random.choice(["0fffff", "00ffff", "000fff"])
+        # Random starts cover odd nonces and digit-count changes, as partitioned solves use them
+        start = random.choice([0, random.randrange(500000), random.choice([99990, 999, 9999]) - random.randrange(50)])
+        expected = legacy_generate_answer_range(seed, diff, config, start, 500000)
+        actual = generate_answer_range(seed, diff, config, start, 500000)
+        assert expected == actual, (seed, diff, expected, actual)
+    print(f"identical answers for {rounds} random seeds/configs")
+
+
+def bench(func, config, iterations):
+    start = time.perf_counter()
+    # An unreachable difficulty makes both loops walk the full range
+    func("0.5", "00000000", config, 0, iterations)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    check_identical()
+    iterations = 100000
+    config = get_config(USER_AGENT)
+    legacy = incremental = float("inf")
+    for _ in range(5):
+        legacy = min(legacy, bench(legacy_generate_answer_range, config, iterations))
+        incremental = min(incremental, bench(generate_answer_range, config, iterations))
+    print(f"legacy:      {iterations / legacy:,.0f} nonces/s ({legacy:.2f}s)")
+    print(f"incremental: {iterations / incremental:,.0f} nonces/s ({incremental:.2f}s)")
+    print(f"speedup:     {legacy / incremental:.2f}x")
@@ -0,0 +1,119 @@
+"""
+Compares chat.completion.chunk rendering with ChunkEncoder against the previous
+mutate-a-dict + json.dumps approach, over upstream conversation streams replayed
+through chatgpt.chatFormat.stream_response, and checks the bytes are identical.
+
+The streams are synthesized in the upstream format (cumulative message parts, one
+event per token) from texts covering ASCII, CJK, emoji, quotes, backslashes and
+control characters.
+
+Run from the repository root: python -m benchmarks.sse_encoder
+"""
+import asyncio
+import json
+import time
+
+from chatgpt.chatFormat import stream_response
+from chatgpt.deltaEncoding import decode_events
+from chatgpt.sseEncoder import ChunkEncoder, loads
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog. " * 40,
+    "流式响应的每一个片段都需要单独编码。" * 40,
+    "Emoji 🚀🔥 and accents: café, naïve, Ærøskøbing. " * 30,
+    'Code: print("a\\tb")\n\tif x < 0 and y > 1: return {"k": [1, 2]}\x7f\x01\n' * 20,
+]
+
+
+class FakeService:
+    prompt_tokens = 0
+
+    def __init__(self, history_disabled):
+        self.history_disabled = history_disabled
+
+    async def close_response(self):
+        pass
+
+
+def record_stream(text, token_size=4):
+    events = []
+    message = {"id": "msg-1", "author": {"role": "assistant"}, "status": "in_progress", "recipient": "all",
+               "content": {"content_type": "text", "parts": [""]}, "metadata": {"model_slug": "gpt-4o"}}
+    for end in range(0, len(text) + token_size, token_size):
+        message["content"]["parts"] = [text[:end]]
+        events.append("data: " + json.dumps({"message": message, "conversation_id": "conv-1"}) + "\n\n")
+    message["status"] = "finished_successfully"
+    message["end_turn"] = True
+    events.append("data: " + json.dumps({"message": message, "conversation_id": "conv-1"}) + "\n\n")
+    events.append("data: [DONE]\n\n")
+    return [event.encode() for event in events]
+
+
+async def replay(events, history_disabled):
+    async def response():
+        for event in events:
+            yield event
+
+    return [chunk async for chunk in stream_response(FakeService(history_disabled), decode_events(response()), "gpt-4o", 10 ** 6)]
+
+
+def check_identical(streams):
+    count = 0
+    for events in streams:
+        for history_disabled in (True, False):
+            for chunk in asyncio.run(replay(events, history_disabled)):
+                if chunk.startswith("data: {"):
+                    # json.dumps of the parsed chunk is what the dict-based code emitted
+                    assert chunk == f"data: {json.dumps(json.loads(chunk[6:]))}\n\n", chunk
+                    count += 1
+    print(f"identical bytes for {count} chunks")
+
+
+def legacy_encode(deltas):
+    chunk_new_data = {
+        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 1700000000, "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": {}, "logprobs": None, "finish_reason": None}],
+        "system_fingerprint": "fp_bench",
+    }
+    out = []
+    for delta in deltas:
+        chunk_new_data["choices"][0]["delta"] = delta
+        chunk_new_data["choices"][0]["finish_reason"] = None
+        chunk_new_data.update({"message_id": "msg-1", "conversation_id": "conv-1"})
+        out.append(f"data: {json.dumps(chunk_new_data)}\n\n")
+    return out
+
+
+def encoder_encode(deltas):
+    encoder = ChunkEncoder("chatcmpl-bench", 1700000000, "gpt-4o", "fp_bench")
+    return [encoder.encode(delta, None, "msg-1", "conv-1", with_ids=True) for delta in deltas]
+
+
+def best_of(func, *args, rounds=5):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    streams = [record_stream(text) for text in TEXTS]
+    check_identical(streams)
+
+    deltas = []
+    for text in TEXTS:
+        deltas += [{"content": text[i:i + 4]} for i in range(0, len(text), 4)]
+    deltas *= 20
+    assert legacy_encode(deltas) == encoder_encode(deltas)
+    legacy = best_of(legacy_encode, deltas)
+    encoded = best_of(encoder_encode, deltas)
+    print(f"encode json.dumps:    {len(deltas) / legacy:,.0f} chunks/s")
+    print(f"encode ChunkEncoder:  {len(deltas) / encoded:,.0f} chunks/s ({legacy / encoded:.2f}x)")
+
+    events = [event.decode()[6:] for events in streams for event in events if event.startswith(b"data: {")] * 5
+    stdlib = best_of(lambda: [json.loads(event) for event in events])
+    fast = best_of(lambda: [loads(event) for event in events])
+    print(f"decode json.loads:    {len(events) / stdlib:,.0f} events/s")
+    print(f"decode sseEncoder:    {len(events) / fast:,.0f} events/s ({stdlib / fast:.2f}x)")
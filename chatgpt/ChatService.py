@@ -1,19 +1,25 @@
 import asyncio
+import hashlib
 import json
 import random
+import time
 import uuid
 
 from fastapi import HTTPException
-from starlette.concurrency import run_in_threadpool
 
-from api.files import get_image_size, get_file_extension, determine_file_use_case
+from api.files import FileStream, downscale_image, get_image_size, get_file_extension, determine_file_use_case
 from api.models import model_proxy
 from chatgpt.authorization import get_req_token, verify_token, get_fp
 from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response, head_process_response
 from chatgpt.chatLimit import check_is_limit, handle_request_limit
-from chatgpt.proofofWork import get_config, get_dpl, get_answer_token, get_requirements_token
-
-from utils.Client import Client
+from chatgpt.deltaEncoding import supported_encodings
+from chatgpt.powSolver import pow_solver
+from chatgpt.proofofWork import get_dpl
+from chatgpt.requirementsPool import requirements_pool
+from chatgpt.tokenScheduler import token_scheduler
+from chatgpt.uploadCache import upload_cache
+
+from utils.Client import session_pool
 from utils.Logger import logger
 from utils.config import (
     chatgpt_base_url_list,
@@ -27,18 +33,31 @@ from utils.config import (
     auth_key,
     turnstile_solver_url,
     oai_language,
+    authorization_list,
+    downscale_images,
+    upload_ready_timeout,
 )
 
 
 class ChatService:
     def __init__(self, origin_token=None):
         # self.user_agent = random.choice(user_agents_list) if user_agents_list else "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
-        self.req_token = get_req_token(origin_token)
+        self.origin_token = origin_token
+        self.req_token = None
+        self.token_acquired = False
         self.chat_token = "gAAAAAB"
         self.s = None
         self.ws = None
 
     async def set_dynamic_data(self, data):
+        self.data = data
+        await self.set_model()
+        self.req_token = await get_req_token(self.origin_token, model=self.req_model)
+        self.req_token = await token_scheduler.acquire(
+            self.req_token, self.req_model, pooled=self.origin_token in authorization_list
+        )
+        self.token_acquired = True
+
         if self.req_token:
             req_len = len(self.req_token.split(","))
             if req_len == 1:
@@ -52,7 +71,7 @@ class ChatService:
             self.access_token = None
             self.account_id = None
 
-        self.fp = get_fp(self.req_token)
+        self.fp = await get_fp(self.req_token)
         self.proxy_url = self.fp.get("proxy_url")
         self.user_agent = self.fp.get("user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36 Edg/130.0.0.0")
         self.impersonate = self.fp.get("impersonate", "safari15_3")
@@ -61,8 +80,6 @@ class ChatService:
         logger.info(f"Request UA: {self.user_agent}")
         logger.info(f"Request impersonate: {self.impersonate}")
 
-        self.data = data
-        await self.set_model()
         if enable_limit and self.req_token:
             limit_response = await handle_request_limit(self.req_token, self.req_model)
             if limit_response:
@@ -84,7 +101,7 @@ class ChatService:
         self.host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
         self.ark0se_token_url = random.choice(ark0se_token_url_list) if ark0se_token_url_list else None
 
-        self.s = Client(proxy=self.proxy_url, impersonate=self.impersonate)
+        self.s = session_pool.client(proxy=self.proxy_url, impersonate=self.impersonate)
 
         self.oai_device_id = str(uuid.uuid4())
         self.persona = None
@@ -94,6 +111,7 @@ class ChatService:
 
         self.chat_headers = None
         self.chat_request = None
+        self.chat_response = None
 
         self.base_headers = {
             'accept': '*/*',
@@ -164,8 +182,7 @@ class ChatService:
         url = f'{self.base_url}/sentinel/chat-requirements'
         headers = self.base_headers.copy()
         try:
-            config = get_config(self.user_agent)
-            p = get_requirements_token(config)
+            config, p = await requirements_pool.get(self.user_agent, self.host_url)
             data = {'p': p}
             r = await self.s.post(url, headers=headers, json=data, timeout=5)
             if r.status_code == 200:
@@ -227,7 +244,7 @@ class ChatService:
                     if not self.ark0se_token_url:
                         raise HTTPException(status_code=403, detail="Ark0se service required")
                     ark0se_dx = ark0se.get("dx")
-                    ark0se_client = Client(impersonate=self.fp.get("impersonate", "safari15_3"))
+                    ark0se_client = session_pool.client(impersonate=self.fp.get("impersonate", "safari15_3"))
                     try:
                         r2 = await ark0se_client.post(
                             url=self.ark0se_token_url, json={"blob": ark0se_dx, "method": ark0se_method}, timeout=15
@@ -250,8 +267,8 @@ class ChatService:
                     if proofofwork_diff <= pow_difficulty:
                         raise HTTPException(status_code=403, detail=f"Proof of work difficulty too high: {proofofwork_diff}")
                     proofofwork_seed = proofofwork.get("seed")
-                    self.proof_token, solved = await run_in_threadpool(
-                        get_answer_token, proofofwork_seed, proofofwork_diff, config
+                    self.proof_token, solved = await pow_solver.get_answer_token(
+                        proofofwork_seed, proofofwork_diff, config
                     )
                     if not solved:
                         raise HTTPException(status_code=403, detail="Failed to solve proof of work")
@@ -268,6 +285,8 @@ class ChatService:
                 if "cf-spinner-please-wait" in detail:
                     raise HTTPException(status_code=r.status_code, detail="cf-spinner-please-wait")
                 if r.status_code == 429:
+                    # Keep the scheduler off this token for a while even without a clears_in
+                    check_is_limit(detail, token=self.req_token, model=self.req_model, default_clears_in=60)
                     raise HTTPException(status_code=r.status_code, detail="rate-limit")
                 raise HTTPException(status_code=r.status_code, detail=detail)
         except HTTPException as e:
@@ -322,6 +341,7 @@ class ChatService:
             "parent_message_id": self.parent_message_id if self.parent_message_id else f"{uuid.uuid4()}",
             "reset_rate_limits": False,
             "suggestions": [],
+            "supported_encodings": supported_encodings,
             "timezone_offset_min": -480,
             "variant_purpose": "comparison_implicit",
             "websocket_request_id": f"{uuid.uuid4()}",
@@ -335,6 +355,7 @@ class ChatService:
             url = f'{self.base_url}/conversation'
             stream = self.data.get("stream", False)
             r = await self.s.post_stream(url, headers=self.chat_headers, json=self.chat_request, timeout=10, stream=True)
+            self.chat_response = r
             if r.status_code != 200:
                 rtext = await r.atext()
                 if "application/json" == r.headers.get("Content-Type", ""):
@@ -364,7 +385,8 @@ class ChatService:
                     return stream_response(self, res, self.resp_model, self.max_tokens)
                 else:
                     return await format_not_stream_response(
-                        stream_response(self, res, self.resp_model, self.max_tokens),
+                        self,
+                        res,
                         self.prompt_tokens,
                         self.max_tokens,
                         self.resp_model,
@@ -444,8 +466,14 @@ class ChatService:
         headers.pop('authorization', None)
         headers.pop('oai-device-id', None)
         headers.pop('oai-language', None)
+        if isinstance(file_content, FileStream):
+            # Blob storage rejects chunked PUTs, so the size is sent up front
+            headers['content-length'] = str(file_content.size)
+            body = {"content": file_content.chunks()}
+        else:
+            body = {"data": file_content}
         try:
-            r = await self.s.put(upload_url, headers=headers, data=file_content, timeout=60)
+            r = await self.s.put(upload_url, headers=headers, timeout=60, **body)
             if r.status_code == 201:
                 return True
             else:
@@ -458,14 +486,32 @@ class ChatService:
         if not file_content or not mime_type:
             return None
 
+        if isinstance(file_content, FileStream):
+            # Streams know their digest up front unless they are piped straight through
+            digest, head, file_size = file_content.sha256, file_content.head, file_content.size
+        else:
+            if len(file_content) > 1024 * 1024:
+                digest = await asyncio.to_thread(lambda: hashlib.sha256(file_content).hexdigest())
+            else:
+                digest = hashlib.sha256(file_content).hexdigest()
+            head, file_size = file_content, len(file_content)
+        cache_key = (self.req_token, self.account_id, mime_type)
+        file_meta = upload_cache.get(cache_key + (digest,)) if digest else None
+        if file_meta:
+            logger.info(f"Reusing uploaded file: {file_meta['file_id']}")
+            return file_meta
+
+        if downscale_images and mime_type.startswith("image/") and not isinstance(file_content, FileStream):
+            file_content = await downscale_image(file_content)
+            head, file_size = file_content, len(file_content)
+
         width, height = None, None
         if mime_type.startswith("image/"):
             try:
-                width, height = await get_image_size(file_content)
+                width, height = await get_image_size(head)
             except Exception as e:
                 logger.error(f"Error image mime_type, change to text/plain: {e}")
                 mime_type = 'text/plain'
-        file_size = len(file_content)
         file_extension = await get_file_extension(mime_type)
         file_name = f"{uuid.uuid4()}{file_extension}"
         use_case = await determine_file_use_case(mime_type)
@@ -485,23 +531,44 @@ class ChatService:
                         "use_case": use_case,
                     }
                     logger.info(f"File_meta: {file_meta}")
+                    digest = digest or file_content.sha256
+                    if digest:
+                        upload_cache.put(cache_key + (digest,), file_meta)
                     return file_meta
 
-    async def check_upload(self, file_id):
+    async def get_retrieval_status(self, file_id, timeout=5):
         url = f'{self.base_url}/files/{file_id}'
         headers = self.base_headers.copy()
         try:
-            for i in range(30):
-                r = await self.s.get(url, headers=headers, timeout=5)
-                if r.status_code == 200:
-                    res = r.json()
-                    retrieval_index_status = res.get('retrieval_index_status', '')
-                    if retrieval_index_status == "success":
-                        break
-                await asyncio.sleep(1)
-            return True
-        except HTTPException:
-            return False
+            r = await self.s.get(url, headers=headers, timeout=timeout)
+            if r.status_code == 200:
+                return r.json().get('retrieval_index_status', '')
+        except Exception as e:
+            logger.error(f"Failed to check upload {file_id}: {e}")
+        return None
+
+    async def check_uploads(self, file_ids):
+        """Waits until every file reports retrieval_index_status success, or UPLOAD_READY_TIMEOUT passes.
+
+        All pending files are polled together each round; the pause between rounds
+        starts at 0.25 s and doubles up to 4 s.
+        """
+        pending = list(dict.fromkeys(file_ids))
+        deadline = time.monotonic() + upload_ready_timeout
+        delay = 0.25
+        while pending:
+            # A round never runs past the deadline, however slow the upstream answers
+            timeout = max(0.1, min(5, deadline - time.monotonic()))
+            statuses = await asyncio.gather(*(self.get_retrieval_status(file_id, timeout) for file_id in pending))
+            pending = [file_id for file_id, status in zip(pending, statuses) if status != "success"]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 4)
+        if pending:
+            logger.warning(f"Files not indexed after {upload_ready_timeout}s: {pending}")
+        return not pending
 
     async def get_response_file_url(self, conversation_id, message_id, sandbox_path):
         try:
@@ -517,9 +584,21 @@ class ChatService:
             logger.info("Failed to get response file url")
             return None
 
+    async def close_response(self):
+        """Aborts the upstream conversation stream once the answer is complete."""
+        r, self.chat_response = self.chat_response, None
+        quit_now = getattr(r, "quit_now", None)
+        if quit_now is not None:
+            quit_now.set()
+
     async def close_client(self):
+        await self.close_response()
+        if self.token_acquired:
+            token_scheduler.release(self.req_token)
+            self.token_acquired = False
         if self.s:
             await self.s.close()
+            self.s = None
         if self.ws:
             await self.ws.close()
             del self.ws
@@ -1,5 +1,3 @@
-import asyncio
-import json
 import random
 import uuid
 
@@ -10,61 +8,45 @@ from fastapi import HTTPException
 
 import utils.config as configs
 import utils.globals as globals
-from chatgpt.refreshToken import rt2ac
+from chatgpt.refreshToken import rt2ac, bulk_refresher
+from chatgpt.sharedState import shared_state_sync
+from chatgpt.tokenScheduler import token_scheduler
 from utils.Logger import logger
 
 
-def get_req_token(req_token, seed=None):
+async def get_req_token(req_token, seed=None, model=None):
     if configs.auto_seed:
-        available_token_list = list(set(globals.token_list) - set(globals.error_token_list))
-        length = len(available_token_list)
-        if seed and length > 0:
-            if seed not in globals.seed_map.keys():
-                globals.seed_map[seed] = {"token": random.choice(available_token_list), "conversations": []}
-                with open(globals.SEED_MAP_FILE, "w") as f:
-                    json.dump(globals.seed_map, f, indent=4)
+        if seed and len(token_scheduler) > 0:
+            seed_data = await globals.state.get_seed(seed)
+            if seed_data is None:
+                globals.state.set_seed_token(seed, token_scheduler.pick(model))
             else:
-                req_token = globals.seed_map[seed]["token"]
+                req_token = seed_data["token"]
             return req_token
 
         if req_token in configs.authorization_list:
-            if len(available_token_list) > 0:
-                if configs.random_token:
-                    req_token = random.choice(available_token_list)
-                    return req_token
-                else:
-                    globals.count += 1
-                    globals.count %= length
-                    return available_token_list[globals.count]
-            else:
-                return None
+            return token_scheduler.pick(model)
         else:
             return req_token
     else:
-        seed = req_token
-        if seed not in globals.seed_map.keys():
+        seed_data = await globals.state.get_seed(req_token)
+        if seed_data is None:
             raise HTTPException(status_code=401, detail={"error": "Invalid Seed"})
-        return globals.seed_map[seed]["token"]
+        return seed_data["token"]
 
 
-def get_fp(req_token):
-    fp = globals.fp_map.get(req_token, {})
+async def get_fp(req_token):
+    fp = await globals.state.get_fp(req_token)
     if fp and fp.get("user-agent") and fp.get("impersonate"):
         if "proxy_url" in fp.keys() and fp["proxy_url"] is None and fp["proxy_url"] not in configs.proxy_url_list:
             fp["proxy_url"] = random.choice(configs.proxy_url_list) if configs.proxy_url_list else None
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            globals.state.set_fp(req_token, fp)
         if globals.impersonate_list and "impersonate" in fp.keys() and fp["impersonate"] not in globals.impersonate_list:
             fp["impersonate"] = random.choice(globals.impersonate_list)
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            globals.state.set_fp(req_token, fp)
         if configs.user_agents_list and "user-agent" in fp.keys() and fp["user-agent"] not in configs.user_agents_list:
             fp["user-agent"] = random.choice(configs.user_agents_list)
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            globals.state.set_fp(req_token, fp)
         fp = {k.lower(): v for k, v in fp.items()}
         return fp
     else:
@@ -86,9 +68,7 @@ def get_fp(req_token):
         if not req_token:
             return fp
         else:
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            globals.state.set_fp(req_token, fp)
             return fp
 
 
@@ -116,12 +96,14 @@ async def verify_token(req_token):
             return req_token
 
 
-async def refresh_all_tokens(force_refresh=False):
-    for token in list(set(globals.token_list) - set(globals.error_token_list)):
-        if len(token) == 45:
-            try:
-                await asyncio.sleep(0.5)
-                await rt2ac(token, force_refresh=force_refresh)
-            except HTTPException:
-                pass
+async def refresh_all_tokens(force_refresh=False, window=0):
+    # With several workers only one runs the bulk refresh, the others read its results
+    if not shared_state_sync.acquire_lease("bulk_refresh", window + 10 * 60):
+        logger.info("Bulk refresh is running in another worker.")
+        return
+    try:
+        tokens = [token for token in set(globals.token_list) - set(globals.error_token_list) if len(token) == 45]
+        await bulk_refresher.run(tokens, force_refresh=force_refresh, window=window)
+    finally:
+        shared_state_sync.release_lease("bulk_refresh")
     logger.info("All tokens refreshed.")
@@ -10,35 +10,37 @@ import pybase64
 import websockets
 from fastapi import HTTPException
 
-from api.files import get_file_content
+from api.files import get_file_content, get_file_stream
 from api.models import model_system_fingerprint
-from api.tokens import split_tokens_from_content, calculate_image_tokens, num_tokens_from_messages
+from api.tokens import TokenCounter, calculate_image_tokens, num_tokens_from_messages
+from chatgpt.deltaEncoding import DONE, decode_events
+from chatgpt.sseEncoder import ChunkEncoder
 from utils.Logger import logger
+from utils.config import upload_concurrency, stream_uploads
 
 moderation_message = "I'm sorry, I cannot provide or engage in any content related to pornography, violence, or any unethical material. If you have any other questions or need assistance, please feel free to let me know. I'll do my best to provide support and assistance."
 
 
-async def format_not_stream_response(response, prompt_tokens, max_tokens, model):
+async def format_not_stream_response(service, response, prompt_tokens, max_tokens, model):
     chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    all_text = ""
-    async for chunk in response:
-        try:
-            if chunk.startswith("data: [DONE]"):
+    counter = TokenCounter(model, max_tokens)
+    texts = []
+    async for item in response_deltas(service, response):
+        if item is DONE:
+            break
+        text = item[0].get("content")
+        if text:
+            texts.append(counter.feed(text))
+            if counter.finished:
+                await service.close_response()
                 break
-            elif not chunk.startswith("data: "):
-                continue
-            else:
-                chunk = json.loads(chunk[6:])
-                if not chunk["choices"][0].get("delta"):
-                    continue
-                all_text += chunk["choices"][0]["delta"]["content"]
-        except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
-            continue
-    content, completion_tokens, finish_reason = await split_tokens_from_content(all_text, max_tokens, model)
+    texts.append(counter.flush())
+    content = "".join(texts)
+    completion_tokens = counter.count
+    finish_reason = "length" if completion_tokens >= max_tokens else "stop"
     message = {
         "role": "assistant",
         "content": content,
@@ -109,21 +111,21 @@ async def wss_stream_response(websocket, conversation_id):
 
 
 async def head_process_response(response):
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
-        if chunk.startswith("data: {"):
-            chunk_old_data = json.loads(chunk[6:])
-            message = chunk_old_data.get("message", {})
-            if not message and "error" in chunk_old_data:
-                return response, False
-            role = message.get('author', {}).get('role')
-            if role == 'user' or role == 'system':
-                continue
+    events = decode_events(response)
+    async for chunk_old_data in events:
+        if chunk_old_data is DONE:
+            continue
+        message = chunk_old_data.get("message", {})
+        if not message and "error" in chunk_old_data:
+            return events, False
+        role = message.get('author', {}).get('role')
+        if role == 'user' or role == 'system':
+            continue
 
-            status = message.get("status")
-            if status == "in_progress":
-                return response, True
-    return response, False
+        status = message.get("status")
+        if status == "in_progress":
+            return events, True
+    return events, False
 
 
 async def stream_response(service, response, model, max_tokens):
@@ -131,7 +133,67 @@ async def stream_response(service, response, model, max_tokens):
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    completion_tokens = 0
+    with_ids = not service.history_disabled
+    counter = TokenCounter(model, max_tokens)
+    message_id = conversation_id = None
+
+    encoder = ChunkEncoder(chat_id, created_time, model, system_fingerprint)
+    yield encoder.encode({"role": "assistant", "content": ""})
+
+    def get_usage():
+        completion_tokens = counter.count
+        return {
+            "prompt_tokens": service.prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": service.prompt_tokens + completion_tokens
+        }
+
+    deltas = response_deltas(service, response)
+    async for item in deltas:
+        if item is DONE:
+            text = counter.flush()
+            if counter.finished:
+                # The held-back text reached max_tokens, the answer was cut short after all
+                yield encoder.encode({"content": text} if text else {}, "length", message_id, conversation_id,
+                                     with_ids, get_usage())
+            elif text:
+                yield encoder.encode({"content": text}, None, message_id, conversation_id, with_ids)
+            yield "data: [DONE]\n\n"
+            continue
+
+        delta, finish_reason, message_id, conversation_id = item
+        if delta.get("content"):
+            # The counter holds back a partial word until it knows where the token ends
+            text = counter.feed(delta["content"])
+            if not counter.finished and finish_reason:
+                text += counter.flush()
+            if counter.finished:
+                finish_reason = "length"
+            if not text and not finish_reason:
+                continue
+            delta = dict(delta, content=text) if text else {}
+        elif finish_reason:
+            text = counter.flush()
+            if counter.finished:
+                finish_reason = "length"
+            if text:
+                delta = dict(delta, content=text)
+
+        usage = get_usage() if finish_reason else None
+        yield encoder.encode(delta, finish_reason, message_id, conversation_id, with_ids, usage)
+        if counter.finished:
+            await deltas.aclose()
+            await service.close_response()
+            yield "data: [DONE]\n\n"
+            break
+
+
+async def response_deltas(service, response):
+    """Turns upstream events into (delta, finish_reason, message_id, conversation_id).
+
+    Yields DONE where the stream should end; both the streaming and non-streaming
+    responses are built from this.
+    """
     len_last_content = 0
     len_last_citation = 0
     last_message_id = None
@@ -140,33 +202,13 @@ async def stream_response(service, response, model, max_tokens):
     model_slug = None
     end = False
 
-    chunk_new_data = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": created_time,
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"role": "assistant", "content": ""},
-                "logprobs": None,
-                "finish_reason": None
-            }
-        ]
-    }
-    if system_fingerprint:
-        chunk_new_data["system_fingerprint"] = system_fingerprint
-    yield f"data: {json.dumps(chunk_new_data)}\n\n"
-
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
+    async for chunk_old_data in response:
         if end:
             logger.info(f"Response Model: {model_slug}")
-            yield "data: [DONE]\n\n"
+            yield DONE
             break
         try:
-            if chunk.startswith("data: {"):
-                chunk_old_data = json.loads(chunk[6:])
+            if chunk_old_data is not DONE:
                 finish_reason = None
                 message = chunk_old_data.get("message", {})
                 conversation_id = chunk_old_data.get("conversation_id")
@@ -244,10 +286,6 @@ async def stream_response(service, response, model, max_tokens):
 
                     delta = {"content": new_text}
                     last_content_type = outer_content_type
-                    if completion_tokens >= max_tokens:
-                        delta = {}
-                        finish_reason = "length"
-                        end = True
                 elif status == "finished_successfully":
                     if content.get("content_type") == "multimodal_text":
                         parts = content.get("parts", [])
@@ -296,28 +334,16 @@ async def stream_response(service, response, model, max_tokens):
                 last_role = role
                 if not end and not delta.get("content"):
                     delta = {"role": "assistant", "content": ""}
-                chunk_new_data["choices"][0]["delta"] = delta
-                chunk_new_data["choices"][0]["finish_reason"] = finish_reason
-                if not service.history_disabled:
-                    chunk_new_data.update({
-                        "message_id": message_id,
-                        "conversation_id": conversation_id,
-                    })
-                completion_tokens += 1
-                yield f"data: {json.dumps(chunk_new_data)}\n\n"
-            elif chunk.startswith("data: [DONE]"):
-                logger.info(f"Response Model: {model_slug}")
-                yield "data: [DONE]\n\n"
+                yield delta, finish_reason, message_id, conversation_id
             else:
-                continue
+                logger.info(f"Response Model: {model_slug}")
+                yield DONE
         except Exception as e:
-            if chunk.startswith("data: "):
-                chunk_data = json.loads(chunk[6:])
-                if chunk_data.get("error"):
-                    logger.error(f"Error: {chunk_data.get('error')}")
-                    yield "data: [DONE]\n\n"
-                    break
-            logger.error(f"Error: {chunk}, details: {str(e)}")
+            if chunk_old_data is not DONE and chunk_old_data.get("error"):
+                logger.error(f"Error: {chunk_old_data.get('error')}")
+                yield DONE
+                break
+            logger.error(f"Error: {chunk_old_data}, details: {str(e)}")
             continue
 
 
@@ -361,62 +387,120 @@ def format_messages_with_url(content):
     return new_content
 
 
+class AttachmentError(Exception):
+    """A file that could not be attached; its message is safe to show the model."""
+
+
+async def upload_attachment(service, url, detail):
+    if stream_uploads:
+        file_stream = await get_file_stream(url)
+        if not file_stream:
+            raise AttachmentError("download failed")
+        try:
+            file_meta = await service.upload_file(file_stream, file_stream.mime_type)
+        finally:
+            await file_stream.close()
+    else:
+        file_content, mime_type = await get_file_content(url)
+        if not file_content:
+            raise AttachmentError("download failed")
+        file_meta = await service.upload_file(file_content, mime_type)
+    if not file_meta:
+        raise AttachmentError("upload failed")
+    file_id = file_meta["file_id"]
+    file_size = file_meta["size_bytes"]
+    file_name = file_meta["file_name"]
+    mime_type = file_meta["mime_type"]
+    use_case = file_meta["use_case"]
+    if mime_type.startswith("image/"):
+        width, height = file_meta["width"], file_meta["height"]
+        part = {
+            "content_type": "image_asset_pointer",
+            "asset_pointer": f"file-service://{file_id}",
+            "size_bytes": file_size,
+            "width": width,
+            "height": height
+        }
+        attachment = {
+            "id": file_id,
+            "size": file_size,
+            "name": file_name,
+            "mime_type": mime_type,
+            "width": width,
+            "height": height
+        }
+        return part, attachment, await calculate_image_tokens(width, height, detail), None
+    attachment = {
+        "id": file_id,
+        "size": file_size,
+        "name": file_name,
+        "mime_type": mime_type,
+    }
+    # Documents are only usable once the upstream has indexed them
+    return None, attachment, file_size // 1000, None if use_case == "ace_upload" else file_id
+
+
+async def upload_attachments(service, images):
+    """Uploads (url, detail) pairs, at most UPLOAD_CONCURRENCY at a time.
+
+    Results are in the order of images; a failed attachment gives its exception.
+    Returns once the uploaded documents are indexed or the wait times out.
+    """
+    semaphore = asyncio.Semaphore(upload_concurrency)
+
+    async def run(url, detail):
+        async with semaphore:
+            return await upload_attachment(service, url, detail)
+
+    results = await asyncio.gather(*(run(url, detail) for url, detail in images), return_exceptions=True)
+    pending = [result[3] for result in results if not isinstance(result, BaseException) and result[3]]
+    if pending:
+        await service.check_uploads(pending)
+    return results
+
+
 async def api_messages_to_chat(service, api_messages, upload_by_url=False):
     file_tokens = 0
-    chat_messages = []
+    contents = []
+    images = []
     for api_message in api_messages:
-        role = api_message.get('role')
         content = api_message.get('content')
         if upload_by_url:
             if isinstance(content, str):
                 content = format_messages_with_url(content)
+        if isinstance(content, list):
+            for i in content:
+                if i.get("type") == "image_url":
+                    image_url = i.get("image_url")
+                    images.append((image_url.get("url"), image_url.get("detail", "auto")))
+        contents.append(content)
+    uploads = iter(await upload_attachments(service, images) if images else [])
+
+    chat_messages = []
+    for index, (api_message, content) in enumerate(zip(api_messages, contents)):
+        role = api_message.get('role')
         if isinstance(content, list):
             parts = []
             attachments = []
             content_type = "multimodal_text"
+            image_index = 0
             for i in content:
                 if i.get("type") == "text":
                     parts.append(i.get("text"))
                 elif i.get("type") == "image_url":
-                    image_url = i.get("image_url")
-                    url = image_url.get("url")
-                    detail = image_url.get("detail", "auto")
-                    file_content, mime_type = await get_file_content(url)
-                    file_meta = await service.upload_file(file_content, mime_type)
-                    if file_meta:
-                        file_id = file_meta["file_id"]
-                        file_size = file_meta["size_bytes"]
-                        file_name = file_meta["file_name"]
-                        mime_type = file_meta["mime_type"]
-                        use_case = file_meta["use_case"]
-                        if mime_type.startswith("image/"):
-                            width, height = file_meta["width"], file_meta["height"]
-                            file_tokens += await calculate_image_tokens(width, height, detail)
-                            parts.append({
-                                "content_type": "image_asset_pointer",
-                                "asset_pointer": f"file-service://{file_id}",
-                                "size_bytes": file_size,
-                                "width": width,
-                                "height": height
-                            })
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                                "width": width,
-                                "height": height
-                            })
-                        else:
-                            if not use_case == "ace_upload":
-                                await service.check_upload(file_id)
-                            file_tokens += file_size // 1000
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                            })
+                    upload = next(uploads)
+                    image_index += 1
+                    if isinstance(upload, BaseException):
+                        logger.error(f"Attachment {image_index} of message {index + 1} failed: {upload}")
+                        # Tell the model, so the answer does not pretend to have seen the file
+                        reason = str(upload) if isinstance(upload, AttachmentError) else "upload failed"
+                        parts.append(f"[Attachment {image_index} could not be attached: {reason}]")
+                        continue
+                    part, attachment, tokens, _ = upload
+                    file_tokens += tokens
+                    if part:
+                        parts.append(part)
+                    attachments.append(attachment)
             metadata = {
                 "attachments": attachments
             }
@@ -1,33 +1,94 @@
+import heapq
 import time
 from datetime import datetime
 
+import utils.globals as globals
 from utils.Logger import logger
+from utils.config import shared_state
+from utils.metrics import metrics
 
-limit_details = {}
 
+class LimitTracker:
+    """Model rate limits per token, expired through a min-heap keyed on the clear time.
 
-def check_is_limit(detail, token, model):
-    if token and isinstance(detail, dict) and detail.get('clears_in'):
-        clear_time = int(time.time()) + detail.get('clears_in')
-        limit_details.setdefault(token, {})[model] = clear_time
+    Every lookup first pops the entries whose clear time has passed, so expired
+    limits and limits of retired tokens never pile up.
+    """
+
+    def __init__(self):
+        self.limits = {}
+        self.limited = {}
+        self.heap = []
+
+    def add(self, token, model, clear_time):
+        self.purge()
+        self.limits.setdefault(token, {})[model] = clear_time
+        self.limited.setdefault(model, set()).add(token)
+        heapq.heappush(self.heap, (clear_time, token, model))
+        metrics.set("limited_tokens", len(self.limits))
+
+    def purge(self, now=None):
+        now = int(time.time()) if now is None else now
+        while self.heap and self.heap[0][0] <= now:
+            clear_time, token, model = heapq.heappop(self.heap)
+            # Skip heap entries superseded by a later limit or dropped with their token
+            if self.limits.get(token, {}).get(model) == clear_time:
+                self._delete(token, model)
+        metrics.set("limited_tokens", len(self.limits))
+
+    def _delete(self, token, model):
+        models = self.limits.get(token, {})
+        models.pop(model, None)
+        if not models:
+            self.limits.pop(token, None)
+        tokens = self.limited.get(model)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.limited[model]
+
+    def discard_token(self, token):
+        for model in list(self.limits.get(token, {})):
+            self._delete(token, model)
+
+    def clear_time(self, token, model):
+        self.purge()
+        return self.limits.get(token, {}).get(model)
+
+    def is_limited(self, token, model):
+        return self.clear_time(token, model) is not None
+
+    def limited_tokens(self, model):
+        self.purge()
+        return self.limited.get(model, set())
+
+
+limit_tracker = LimitTracker()
+
+
+def check_is_limit(detail, token, model, default_clears_in=None):
+    clears_in = detail.get('clears_in') if isinstance(detail, dict) else None
+    clears_in = clears_in or default_clears_in
+    if token and clears_in:
+        clear_time = int(time.time()) + clears_in
+        limit_tracker.add(token, model, clear_time)
+        if shared_state:
+            globals.state.add_limit(token, model, clear_time)
         logger.info(f"{token[:40]}: Reached {model} limit, will be cleared at {datetime.fromtimestamp(clear_time).replace(microsecond=0)}")
 
 
+def is_limited(token, model):
+    return limit_tracker.is_limited(token, model)
+
+
 async def handle_request_limit(token, model):
     try:
-        if limit_details.get(token) and model in limit_details[token]:
-            limit_time = limit_details[token][model]
-            is_limit = limit_time > int(time.time())
-            if is_limit:
-                clear_date = datetime.fromtimestamp(limit_time).replace(microsecond=0)
-                result = f"Request limit exceeded. You can continue with the default model now, or try again after {clear_date}"
-                logger.info(result)
-                return result
-            else:
-                del limit_details[token][model]
-                return None
-    except KeyError as e:
-        logger.error(f"Key error: {e}")
+        limit_time = limit_tracker.clear_time(token, model)
+        if limit_time:
+            clear_date = datetime.fromtimestamp(limit_time).replace(microsecond=0)
+            result = f"Request limit exceeded. You can continue with the default model now, or try again after {clear_date}"
+            logger.info(result)
+            return result
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
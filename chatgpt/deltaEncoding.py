@@ -0,0 +1,126 @@
+from chatgpt.sseEncoder import loads
+from utils.Logger import logger
+
+DONE = "[DONE]"
+supported_encodings = ["v1"]
+
+
+def parse_path(path):
+    keys = []
+    for key in path.split("/")[1:]:
+        key = key.replace("~1", "/").replace("~0", "~")
+        keys.append(int(key) if key.isdigit() else key)
+    return keys
+
+
+class DeltaDecoder:
+    """Rebuilds conversation events from the upstream "v1" delta encoding.
+
+    The server sends the first event of a message whole ({"p": "", "o": "add", "v": {...}})
+    and then only operations on it: append, replace, add, remove, truncate, or a patch
+    holding a list of those. A bare {"v": ...} repeats the previous path and operation,
+    which is how text appends to /message/content/parts/0 are usually sent. After each
+    event the current state is the same dict the full-part format would have carried.
+    """
+
+    def __init__(self):
+        self.state = None
+        self.path = None
+        self.op = None
+
+    def apply(self, delta):
+        if "p" not in delta and "o" not in delta:
+            value = delta.get("v")
+            if self.path is None or (isinstance(value, dict) and "message" in value):
+                self.apply_op("", "add", value)
+            else:
+                self.apply_op(self.path, self.op, value)
+        else:
+            self.apply_op(delta.get("p", self.path or ""), delta.get("o", self.op or "replace"), delta.get("v"))
+        return self.state
+
+    def apply_op(self, path, op, value):
+        if op == "patch":
+            for delta in value:
+                self.apply(delta)
+            return
+        self.path, self.op = path, op
+        if not path:
+            if op in ("add", "replace"):
+                self.state = value
+            elif op == "append" and isinstance(self.state, dict):
+                self.state.update(value)
+            return
+
+        keys = parse_path(path)
+        parent = self.state
+        for key in keys[:-1]:
+            parent = parent[key]
+        key = keys[-1]
+        if isinstance(parent, list):
+            if key == "-" or key >= len(parent):
+                parent.append(None)
+                key = len(parent) - 1
+            elif op == "add":
+                parent.insert(key, None)
+
+        if op in ("add", "replace"):
+            parent[key] = value
+        elif op == "append":
+            current = parent[key] if isinstance(parent, list) else parent.get(key)
+            if current is None:
+                parent[key] = value
+            elif isinstance(current, list):
+                current.extend(value if isinstance(value, list) else [value])
+            elif isinstance(current, dict):
+                current.update(value)
+            else:
+                parent[key] = current + value
+        elif op == "truncate":
+            parent[key] = parent[key][:value]
+        elif op == "remove":
+            del parent[key]
+        else:
+            raise ValueError(f"unknown delta operation: {op}")
+
+
+async def decode_events(response):
+    """Yields parsed upstream conversation events and DONE.
+
+    Works on the lines of either stream format. Events that follow event: delta are
+    applied to a DeltaDecoder and yield its rebuilt state, every other data event is
+    yielded as parsed, so a server that ignores supported_encodings is read as before.
+    """
+    decoder = DeltaDecoder()
+    event = None
+    async for chunk in response:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("utf-8")
+        for line in chunk.split("\n"):
+            if not line:
+                event = None
+                continue
+            if line.startswith("event: "):
+                event = line[7:].strip()
+                continue
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data.startswith("[DONE]"):
+                yield DONE
+                continue
+            try:
+                data = loads(data)
+            except ValueError:
+                logger.error(f"Error: {line}, details: invalid event data")
+                continue
+            if event == "delta_encoding":
+                continue
+            if event == "delta" and isinstance(data, dict):
+                try:
+                    data = decoder.apply(data)
+                except (LookupError, TypeError, ValueError) as e:
+                    logger.error(f"Error: {line}, details: {str(e)}")
+                    continue
+            if isinstance(data, dict):
+                yield data
@@ -0,0 +1,119 @@
+import asyncio
+import math
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+from chatgpt.proofofWork import generate_answer, generate_answer_range, get_unsolved_answer, max_nonce
+from utils.Logger import logger
+from utils.config import pow_workers
+
+MAX_SLOTS = 128
+
+_cancel_flags = None
+
+
+def _init_worker(cancel_flags):
+    global _cancel_flags
+    _cancel_flags = cancel_flags
+
+
+def _solve_partition(seed, diff, config, start, end, slot):
+    return generate_answer_range(seed, diff, config, start, end, should_stop=lambda: _cancel_flags[slot])
+
+
+class PowSolver:
+    """Splits the nonce space of a proof of work across a pool of worker processes.
+
+    Every solve gets a slot in a shared flag array; the first partition that finds an
+    answer wins and the flag tells the remaining partitions of that solve to stop.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._cancel_flags = None
+        self._free_slots = list(range(MAX_SLOTS))
+        self._release_tasks = set()
+
+    @property
+    def enabled(self):
+        return self.workers > 1
+
+    def _get_executor(self):
+        if self._executor is None:
+            # The pool starts lazily inside a process that already runs threads, forking could copy held locks
+            ctx = multiprocessing.get_context("spawn")
+            self._cancel_flags = ctx.RawArray('b', MAX_SLOTS)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=ctx, initializer=_init_worker, initargs=(self._cancel_flags,)
+            )
+            logger.info(f"PoW solver pool started with {self.workers} processes")
+        return self._executor
+
+    async def solve(self, seed, diff, config):
+        if not self.enabled or not self._free_slots:
+            return await run_in_threadpool(generate_answer, seed, diff, config)
+
+        try:
+            executor = self._get_executor()
+        except Exception as e:
+            logger.error(f"Failed to start PoW solver pool, falling back to threads: {e}")
+            self.workers = 0
+            return await run_in_threadpool(generate_answer, seed, diff, config)
+
+        slot = self._free_slots.pop()
+        self._cancel_flags[slot] = 0
+        step = math.ceil(max_nonce / self.workers)
+        futures = [
+            executor.submit(_solve_partition, seed, diff, config, start, min(start + step, max_nonce), slot)
+            for start in range(0, max_nonce, step)
+        ]
+        try:
+            for next_done in asyncio.as_completed([asyncio.wrap_future(future) for future in futures]):
+                answer, solved = await next_done
+                if solved:
+                    return answer, True
+            return get_unsolved_answer(seed), False
+        except Exception as e:
+            logger.error(f"PoW solver pool failed, retrying in thread: {e}")
+            self.shutdown()
+            return await run_in_threadpool(generate_answer, seed, diff, config)
+        finally:
+            self._cancel_flags[slot] = 1
+            for future in futures:
+                future.cancel()
+            task = asyncio.ensure_future(self._release_slot(slot, futures))
+            self._release_tasks.add(task)
+            task.add_done_callback(self._release_tasks.discard)
+
+    async def _release_slot(self, slot, futures):
+        # Partitions already running only stop once they see the flag, keep the slot until they do
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in futures), return_exceptions=True)
+        except Exception as e:
+            logger.error(f"Failed to wait for PoW partitions: {e}")
+        finally:
+            self._free_slots.append(slot)
+
+    async def get_answer_token(self, seed, diff, config):
+        start = time.time()
+        answer, solved = await self.solve(seed, diff, config)
+        end = time.time()
+        logger.info(f'diff: {diff}, time: {int((end - start) * 1e6) / 1e3}ms, solved: {solved}')
+        return "gAAAAAB" + answer, solved
+
+    async def get_requirements_token(self, config):
+        answer, solved = await self.solve(format(random.random()), "0fffff", config)
+        return 'gAAAAAC' + answer
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+pow_solver = PowSolver(pow_workers)
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import json
 import random
@@ -9,17 +10,18 @@ from html.parser import HTMLParser
 
 import pybase64
 
+from utils.Client import session_pool
 from utils.Logger import logger
-from utils.config import conversation_only
+from utils.config import conversation_only, chatgpt_base_url_list
 
 cores = [16, 24, 32]
 screens = [3000, 4000, 6000]
 timeLayout = "%a %b %d %Y %H:%M:%S"
 
-cached_scripts = []
-cached_dpl = ""
-cached_time = 0
-cached_require_proof = ""
+dpl_ttl = 15 * 60
+dpl_refresh_ahead = 60
+dpl_retry_interval = 60
+max_nonce = 500000
 
 navigator_key = [
     "registerProtocolHandler−function registerProtocolHandler() { [native code] }",
@@ -381,56 +383,124 @@ window_key = [
 
 
 class ScriptSrcParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.scripts = []
+        self.dpl = ""
+
     def handle_starttag(self, tag, attrs):
-        global cached_scripts, cached_dpl, cached_time
         if tag == "script":
             attrs_dict = dict(attrs)
             if "src" in attrs_dict:
                 src = attrs_dict["src"]
-                cached_scripts.append(src)
+                self.scripts.append(src)
                 match = re.search(r"c/[^/]*/_", src)
                 if match:
-                    cached_dpl = match.group(0)
-                    cached_time = int(time.time())
+                    self.dpl = match.group(0)
 
 
 def get_data_build_from_html(html_content):
-    global cached_scripts, cached_dpl, cached_time
     parser = ScriptSrcParser()
     parser.feed(html_content)
-    if not cached_scripts:
-        cached_scripts.append("https://chatgpt.com/backend-api/sentinel/sdk.js")
-    if not cached_dpl:
+    scripts, dpl = parser.scripts, parser.dpl
+    if not scripts:
+        scripts.append("https://chatgpt.com/backend-api/sentinel/sdk.js")
+    if not dpl:
         match = re.search(r'<html[^>]*data-build="([^"]*)"', html_content)
         if match:
-            data_build = match.group(1)
-            cached_dpl = data_build
-            cached_time = int(time.time())
-            logger.info(f"Found dpl: {cached_dpl}")
+            dpl = match.group(1)
+            logger.info(f"Found dpl: {dpl}")
+    return scripts, dpl
 
 
-async def get_dpl(service):
-    global cached_scripts, cached_dpl, cached_time
-    if int(time.time()) - cached_time < 15 * 60:
-        return True
-    headers = service.base_headers.copy()
-    cached_scripts = []
-    cached_dpl = ""
-    try:
-        if conversation_only:
+class DplEntry:
+    def __init__(self, host_url):
+        self.host_url = host_url
+        self.scripts = []
+        self.dpl = ""
+        self.fetched_time = 0
+        self.failed_time = 0
+        self.used_time = 0
+        self.refresh_task = None
+        self.headers = {}
+        self.proxy_url = None
+        self.impersonate = "safari15_3"
+
+
+class DplCache:
+    """Scripts and dpl of the ChatGPT homepage, cached per entry of CHATGPT_BASE_URL.
+
+    Only one homepage fetch runs per host at a time. Stale values keep being served
+    while it runs, and a fresh value is fetched ahead of expiry in the background.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_entry(self, host_url=None):
+        if not host_url:
+            host_url = chatgpt_base_url_list[0] if chatgpt_base_url_list else "https://chatgpt.com"
+        entry = self.entries.get(host_url)
+        if entry is None:
+            entry = self.entries[host_url] = DplEntry(host_url)
+        return entry
+
+    async def ensure(self, service):
+        entry = self.get_entry(service.host_url)
+        now = int(time.time())
+        entry.used_time = now
+        entry.headers = {k: v for k, v in service.base_headers.items() if k not in ("authorization", "chatgpt-account-id")}
+        entry.proxy_url = service.proxy_url
+        entry.impersonate = service.impersonate
+        if entry.dpl and now - entry.fetched_time < dpl_ttl - dpl_refresh_ahead:
             return True
-        r = await service.s.get(f"{service.host_url}/", headers=headers, timeout=5)
-        r.raise_for_status()
-        get_data_build_from_html(r.text)
-        if not cached_dpl:
-            raise Exception("No Cached DPL")
-        else:
+        if now - entry.failed_time < dpl_retry_interval:
+            return bool(entry.dpl)
+        if entry.dpl:
+            self.refresh(entry)
             return True
-    except Exception as e:
-        logger.info(f"Failed to get dpl: {e}")
-        cached_dpl = None
-        cached_time = int(time.time())
-        return False
+        return await asyncio.shield(self.refresh(entry))
+
+    def refresh(self, entry):
+        if entry.refresh_task is None or entry.refresh_task.done():
+            entry.refresh_task = asyncio.create_task(self.fetch(entry))
+        return entry.refresh_task
+
+    async def fetch(self, entry):
+        client = session_pool.client(proxy=entry.proxy_url, impersonate=entry.impersonate)
+        try:
+            r = await client.get(f"{entry.host_url}/", headers=entry.headers, timeout=5)
+            r.raise_for_status()
+            scripts, dpl = get_data_build_from_html(r.text)
+            if not dpl:
+                raise Exception("No Cached DPL")
+            entry.scripts, entry.dpl = scripts, dpl
+            entry.fetched_time = int(time.time())
+            self.schedule_refresh(entry)
+            return True
+        except Exception as e:
+            logger.info(f"Failed to get dpl: {e}")
+            entry.failed_time = int(time.time())
+            return False
+        finally:
+            await client.close()
+
+    def schedule_refresh(self, entry):
+        def refresh_if_used():
+            # Hosts nobody asked for in a while fall back to refreshing on demand
+            if int(time.time()) - entry.used_time < 2 * dpl_ttl:
+                self.refresh(entry)
+
+        asyncio.get_running_loop().call_later(dpl_ttl - dpl_refresh_ahead, refresh_if_used)
+
+
+dpl_cache = DplCache()
+
+
+async def get_dpl(service):
+    if conversation_only:
+        return True
+    return await dpl_cache.ensure(service)
 
 
 def get_parse_time():
@@ -438,7 +508,8 @@ def get_parse_time():
     return now.strftime(timeLayout) + " GMT-0500 (Eastern Standard Time)"
 
 
-def get_config(user_agent):
+def get_config(user_agent, host_url=None):
+    dpl_entry = dpl_cache.get_entry(host_url)
     core = random.choice(cores)
     screen = random.choice(screens)
     config = [
@@ -447,8 +518,8 @@ def get_config(user_agent):
         4294705152,
         0,
         user_agent,
-        random.choice(cached_scripts) if cached_scripts else None,
-        cached_dpl,
+        random.choice(dpl_entry.scripts) if dpl_entry.scripts else None,
+        dpl_entry.dpl,
         "en-US",
         "en-US,es-US,en,es",
         0,
@@ -470,24 +541,60 @@ def get_answer_token(seed, diff, config):
 
 
 def generate_answer(seed, diff, config):
+    answer, solved = generate_answer_range(seed, diff, config, 0, max_nonce)
+    if solved:
+        return answer, True
+    return get_unsolved_answer(seed), False
+
+
+def get_unsolved_answer(seed):
+    return "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode()
+
+
+def generate_answer_range(seed, diff, config, start, end, should_stop=None):
     diff_len = len(diff)
-    seed_encoded = seed.encode()
     static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
     static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
     static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
 
     target_diff = bytes.fromhex(diff)
 
-    for i in range(500000):
+    # base64 works on 3-byte groups, so the aligned head of the prefix encodes the same way for every
+    # nonce; hash it once and only feed the encoding of the remaining bytes per nonce.
+    aligned_len = len(static_config_part1) - len(static_config_part1) % 3
+    prefix_encode = pybase64.b64encode(static_config_part1[:aligned_len])
+    carry = static_config_part1[aligned_len:]
+    prefix_hash = hashlib.sha3_512(seed.encode() + prefix_encode)
+
+    buffer = bytearray()
+    offset_i = len(carry)
+    offset_j = len_i = len_j = 0
+    for i in range(start, end):
+        if should_stop and i & 0x3ff == 0 and should_stop():
+            break
         dynamic_json_i = str(i).encode()
-        dynamic_json_j = str(i >> 1).encode()
-        final_json_bytes = static_config_part1 + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3
-        base_encode = pybase64.b64encode(final_json_bytes)
-        hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
-        if hash_value[:diff_len] <= target_diff:
-            return base_encode.decode(), True
+        if len(dynamic_json_i) != len_i or i == start:
+            dynamic_json_j = str(i >> 1).encode()
+            len_i, len_j = len(dynamic_json_i), len(dynamic_json_j)
+            offset_j = offset_i + len_i + len(static_config_part2)
+            buffer = bytearray(carry + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3)
+        else:
+            buffer[offset_i:offset_i + len_i] = dynamic_json_i
+            # i >> 1 only moves on even nonces
+            if not i & 1:
+                dynamic_json_j = str(i >> 1).encode()
+                if len(dynamic_json_j) != len_j:
+                    len_j = len(dynamic_json_j)
+                    buffer = bytearray(carry + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3)
+                else:
+                    buffer[offset_j:offset_j + len_j] = dynamic_json_j
+        suffix_encode = pybase64.b64encode(buffer)
+        hash_state = prefix_hash.copy()
+        hash_state.update(suffix_encode)
+        if hash_state.digest()[:diff_len] <= target_diff:
+            return (prefix_encode + suffix_encode).decode(), True
 
-    return "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode(), False
+    return None, False
 
 
 def get_requirements_token(config):
@@ -496,17 +603,14 @@ def get_requirements_token(config):
 
 
 if __name__ == "__main__":
-    # cached_scripts.append(
-    #     "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3")
-    # cached_dpl = "453ebaec0d44c2decab71692e1bfe39be35a24b3"
-    # cached_time = int(time.time())
     # for i in range(10):
     #     seed = format(random.random())
     #     diff = "000032"
     #     config = get_config("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome")
     #     answer = get_answer_token(seed, diff, config)
-    cached_scripts.append(
+    dpl_entry = dpl_cache.get_entry()
+    dpl_entry.scripts.append(
         "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3")
-    cached_dpl = "dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3"
+    dpl_entry.dpl = "dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3"
     config = get_config("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36")
     get_requirements_token(config)
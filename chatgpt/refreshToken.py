@@ -1,40 +1,296 @@
+import asyncio
+import base64
 import json
 import random
 import time
 
 from fastapi import HTTPException
 
-from utils.Client import Client
+from utils.Client import session_pool
 from utils.Logger import logger
-from utils.config import proxy_url_list
+from utils.config import proxy_url_list, token_refresh_margin, refresh_concurrency, refresh_window, shared_state
 import utils.globals as globals
+from chatgpt.sharedState import shared_state_sync
+from chatgpt.tokenScheduler import token_scheduler
 
+# Fallback lifetime for access tokens whose exp claim cannot be read
+default_ttl = 5 * 24 * 60 * 60
+renew_retry_interval = 5 * 60
+max_backoff = 60
 
-async def rt2ac(refresh_token, force_refresh=False):
-    if not force_refresh and (refresh_token in globals.refresh_map and int(time.time()) - globals.refresh_map.get(refresh_token, {}).get("timestamp", 0) < 5 * 24 * 60 * 60):
-        access_token = globals.refresh_map[refresh_token]["token"]
-        # logger.info(f"refresh_token -> access_token from cache")
-        return access_token
-    else:
+
+def get_jwt_exp(access_token):
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+def get_expires(cache_entry):
+    expires = cache_entry.get("expires") or get_jwt_exp(cache_entry.get("token", ""))
+    return expires or cache_entry.get("timestamp", 0) + default_ttl
+
+
+class TokenRefresher:
+    """Single-flight refresh_token -> access_token exchange with renewal ahead of expiry.
+
+    Renewals run through the BulkRefresher proxy lanes, and the ones already due at
+    startup are spread over the refresh window instead of all firing at once.
+    """
+
+    def __init__(self, margin, window):
+        self.margin = margin
+        self.window = window
+        self.tasks = {}
+        self.handles = {}
+        self.used_time = {}
+        self.batching = 0
+        self.unsaved = set()
+
+    async def get(self, refresh_token, force_refresh=False):
+        self.used_time[refresh_token] = int(time.time())
+        cache_entry = globals.refresh_map.get(refresh_token)
+        if not force_refresh:
+            if cache_entry and int(time.time()) < get_expires(cache_entry):
+                return cache_entry["token"]
+            cache_entry = self.adopt_shared(refresh_token)
+            if cache_entry:
+                return cache_entry["token"]
+        return await asyncio.shield(self.refresh(refresh_token))
+
+    def adopt_shared(self, refresh_token):
+        """Picks up an access token another worker has already exchanged."""
+        if not shared_state:
+            return None
+        cache_entry = globals.state.get_refresh(refresh_token)
+        if cache_entry and int(time.time()) < get_expires(cache_entry):
+            globals.refresh_map[refresh_token] = cache_entry
+            return cache_entry
+        return None
+
+    def refresh(self, refresh_token, proxy_url=None):
+        task = self.tasks.get(refresh_token)
+        if task is None:
+            task = asyncio.create_task(self.exchange(refresh_token, proxy_url))
+            task.add_done_callback(lambda t: t.exception() if not t.cancelled() else None)
+            self.tasks[refresh_token] = task
+        return task
+
+    async def exchange(self, refresh_token, proxy_url=None):
         try:
-            access_token = await chat_refresh(refresh_token)
-            globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": int(time.time())}
-            with open(globals.REFRESH_MAP_FILE, "w") as f:
-                json.dump(globals.refresh_map, f, indent=4)
+            access_token = await chat_refresh(refresh_token, proxy_url)
+            now = int(time.time())
+            expires = get_jwt_exp(access_token) or now + default_ttl
+            globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": now, "expires": expires}
+            self.unsaved.add(refresh_token)
+            if not self.batching:
+                self.save()
             logger.info(f"refresh_token -> access_token with openai: {access_token}")
+            self.schedule_renewal(refresh_token, self.renew_time(globals.refresh_map[refresh_token]))
             return access_token
-        except HTTPException as e:
-            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except HTTPException:
+            if refresh_token not in globals.error_token_list:
+                self.schedule_renewal(refresh_token, int(time.time()) + renew_retry_interval)
+            raise
+        finally:
+            self.tasks.pop(refresh_token, None)
+
+    def renew_time(self, cache_entry):
+        expires = get_expires(cache_entry)
+        timestamp = cache_entry.get("timestamp", 0)
+        # A margin longer than the token lifetime would renew in a tight loop
+        return max(expires - self.margin, timestamp + (expires - timestamp) // 2)
+
+    def is_fresh(self, refresh_token):
+        cache_entry = globals.refresh_map.get(refresh_token)
+        return bool(cache_entry) and int(time.time()) < self.renew_time(cache_entry)
+
+    def save(self):
+        unsaved, self.unsaved = self.unsaved, set()
+        globals.state.save_refresh(globals.refresh_map, unsaved)
+
+    def wants_renewal(self, refresh_token):
+        if refresh_token in globals.error_token_list:
+            return False
+        if refresh_token in globals.token_list:
+            return True
+        # Tokens passed straight in the Authorization header are renewed only while in use
+        cache_entry = globals.refresh_map.get(refresh_token, {})
+        return self.used_time.get(refresh_token, 0) > cache_entry.get("timestamp", 0)
+
+    def schedule_renewal(self, refresh_token, renew_time):
+        if self.margin <= 0:
+            return
+        handle = self.handles.pop(refresh_token, None)
+        if handle:
+            handle.cancel()
+
+        def renew():
+            self.handles.pop(refresh_token, None)
+            if not self.wants_renewal(refresh_token):
+                return
+            now = int(time.time())
+            cache_entry = self.adopt_shared(refresh_token) or globals.refresh_map.get(refresh_token)
+            if cache_entry and self.renew_time(cache_entry) > now:
+                # Already renewed, by a bulk refresh or another worker
+                self.schedule_renewal(refresh_token, self.renew_time(cache_entry))
+            elif not shared_state_sync.acquire_lease(f"refresh:{refresh_token}", 60):
+                # Another worker is renewing it, pick up its result shortly
+                self.schedule_renewal(refresh_token, now + 30)
+            else:
+                bulk_refresher.renew(refresh_token)
+
+        delay = max(0, renew_time - int(time.time()))
+        self.handles[refresh_token] = asyncio.get_running_loop().call_later(delay, renew)
+
+    def start(self):
+        now = int(time.time())
+        due = []
+        for refresh_token, cache_entry in globals.refresh_map.items():
+            if refresh_token in globals.token_list and refresh_token not in globals.error_token_list:
+                renew_time = self.renew_time(cache_entry)
+                if renew_time > now:
+                    self.schedule_renewal(refresh_token, renew_time)
+                else:
+                    due.append((renew_time, refresh_token))
+        # Closest to expiry first, each in its own slot of the window with jitter
+        due.sort()
+        slot = min(self.window, self.margin // 2) / len(due) if due else 0
+        for i, (renew_time, refresh_token) in enumerate(due):
+            self.schedule_renewal(refresh_token, now + int(i * slot + random.uniform(0, slot)))
+
+    def stop(self):
+        for handle in self.handles.values():
+            handle.cancel()
+        self.handles.clear()
+
+
+token_refresher = TokenRefresher(token_refresh_margin, refresh_window)
+
+
+class ProxyLane:
+    def __init__(self, proxy_url, concurrency):
+        self.proxy_url = proxy_url
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.backoff = 0
+
+    def succeeded(self):
+        self.backoff = self.backoff / 2 if self.backoff >= 1 else 0
+
+    def failed(self):
+        self.backoff = min(max(self.backoff * 2, 1), max_backoff)
+
+
+class BulkRefresher:
+    """Refreshes many tokens with bounded concurrency per proxy.
+
+    Starts are spread over the given window with jitter, each proxy backs off
+    while auth0 keeps failing on it, and the refresh cache is saved once when
+    the run finishes. Renewals from TokenRefresher share the same lanes.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = max(1, concurrency)
+        self.task = None
+        self.lanes = [ProxyLane(proxy_url, self.concurrency) for proxy_url in (proxy_url_list or [None])]
+        self.next_lane = 0
+        self.renewals = set()
+        self.status = {"state": "idle"}
+
+    async def run(self, tokens, force_refresh=False, window=0):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.refresh_all(tokens, force_refresh, window))
+        return await asyncio.shield(self.task)
+
+    async def refresh_all(self, tokens, force_refresh, window):
+        now = int(time.time())
+        if not force_refresh:
+            tokens = [token for token in tokens
+                      if token not in globals.refresh_map or now >= get_expires(globals.refresh_map[token])]
+        self.status = {"state": "running", "started_at": now, "finished_at": None, "total": len(tokens),
+                       "done": 0, "refreshed": 0, "failed": 0, "invalid": 0}
+        slot = window / len(tokens) if tokens else 0
+        token_refresher.batching += 1
+        try:
+            await asyncio.gather(*[
+                self.refresh_one(token, self.lanes[i % len(self.lanes)], i * slot + random.uniform(0, slot),
+                                 force_refresh)
+                for i, token in enumerate(tokens)
+            ])
+        finally:
+            token_refresher.batching -= 1
+            if self.status["refreshed"]:
+                token_refresher.save()
+            self.status["state"] = "idle"
+            self.status["finished_at"] = int(time.time())
+        logger.info(f"Bulk refresh finished: {self.status['refreshed']} refreshed, "
+                    f"{self.status['failed']} failed, {self.status['invalid']} invalid.")
+        return self.status
+
+    async def refresh_one(self, refresh_token, lane, delay, force_refresh):
+        await asyncio.sleep(delay)
+        try:
+            if await self.refresh_in_lane(refresh_token, lane, force_refresh):
+                self.status["refreshed"] += 1
+        except HTTPException:
+            if refresh_token in globals.error_token_list:
+                self.status["invalid"] += 1
+            else:
+                self.status["failed"] += 1
+        finally:
+            self.status["done"] += 1
+
+    async def refresh_in_lane(self, refresh_token, lane, force_refresh=False):
+        """Returns False when the token was renewed elsewhere while waiting for the lane."""
+        async with lane.semaphore:
+            if not force_refresh and token_refresher.is_fresh(refresh_token):
+                return False
+            if lane.backoff:
+                await asyncio.sleep(lane.backoff * random.uniform(0.5, 1.5))
+            try:
+                await token_refresher.refresh(refresh_token, lane.proxy_url)
+                lane.succeeded()
+                return True
+            except HTTPException:
+                if refresh_token not in globals.error_token_list:
+                    lane.failed()
+                raise
+
+    def renew(self, refresh_token):
+        lane = self.lanes[self.next_lane % len(self.lanes)]
+        self.next_lane += 1
+        task = asyncio.create_task(self.refresh_in_lane(refresh_token, lane))
+        # Failures are logged by chat_refresh and TokenRefresher schedules the retry
+        task.add_done_callback(lambda t: t.exception() if not t.cancelled() else None)
+        self.renewals.add(task)
+        task.add_done_callback(self.renewals.discard)
+
+    def get_status(self):
+        status = dict(self.status)
+        if status["state"] == "running":
+            status["backoff"] = {lane.proxy_url or "direct": lane.backoff for lane in self.lanes}
+        return status
+
+
+bulk_refresher = BulkRefresher(refresh_concurrency)
+
+
+async def rt2ac(refresh_token, force_refresh=False):
+    return await token_refresher.get(refresh_token, force_refresh=force_refresh)
 
 
-async def chat_refresh(refresh_token):
+async def chat_refresh(refresh_token, proxy_url=None):
     data = {
         "client_id": "pdlLIX2Y72MIl2rhLhTE9VV9bN905kBh",
         "grant_type": "refresh_token",
         "redirect_uri": "com.openai.chat://auth0.openai.com/ios/com.openai.chat/callback",
         "refresh_token": refresh_token
     }
-    client = Client(proxy=random.choice(proxy_url_list) if proxy_url_list else None)
+    if not proxy_url and proxy_url_list:
+        proxy_url = random.choice(proxy_url_list)
+    client = session_pool.client(proxy=proxy_url)
     try:
         r = await client.post("https://auth0.openai.com/oauth/token", json=data, timeout=5)
         if r.status_code == 200:
@@ -42,10 +298,10 @@ async def chat_refresh(refresh_token):
             return access_token
         else:
             if "invalid_grant" in r.text or "access_denied" in r.text:
+                token_scheduler.remove(refresh_token)
                 if refresh_token not in globals.error_token_list:
                     globals.error_token_list.append(refresh_token)
-                    with open(globals.ERROR_TOKENS_FILE, "a", encoding="utf-8") as f:
-                        f.write(refresh_token + "\n")
+                    globals.state.add_error_token(refresh_token)
                 raise Exception(r.text)
             else:
                 raise Exception(r.text[:300])
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from chatgpt.powSolver import pow_solver
+from chatgpt.proofofWork import get_config
+from utils.Logger import logger
+from utils.config import req_pool_size
+from utils.metrics import metrics
+
+# Configs carry a timestamp and the current dpl, so pooled tokens are only handed out for a short while
+POOL_TTL = 120
+MAX_PROFILES = 64
+
+
+class RequirementsPool:
+    """Keeps a few pre-solved requirements tokens per host and user-agent so requests skip the solve.
+
+    Consuming a token schedules a background refill for its profile; an empty or
+    disabled pool falls back to solving inline.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pools = OrderedDict()
+        self.refill_tasks = {}
+
+    async def get(self, user_agent, host_url=None):
+        profile = (host_url, user_agent)
+        pool = self.pools.get(profile)
+        if pool is not None:
+            self.pools.move_to_end(profile)
+        config = token = None
+        while pool:
+            created, pooled_config, pooled_token = pool.popleft()
+            if time.time() - created < POOL_TTL:
+                config, token = pooled_config, pooled_token
+                break
+        self.schedule_refill(profile)
+        if token:
+            metrics.inc("requirements_pool_hits")
+        else:
+            metrics.inc("requirements_pool_misses")
+            config = get_config(user_agent, host_url)
+            token = await pow_solver.get_requirements_token(config)
+        self.update_gauge()
+        return config, token
+
+    def schedule_refill(self, profile):
+        if self.size <= 0 or profile in self.refill_tasks:
+            return
+        if profile not in self.pools:
+            self.pools[profile] = deque()
+            while len(self.pools) > MAX_PROFILES:
+                self.pools.popitem(last=False)
+        self.refill_tasks[profile] = asyncio.create_task(self.refill(profile))
+
+    async def refill(self, profile):
+        host_url, user_agent = profile
+        try:
+            pool = self.pools.get(profile)
+            while pool is not None and len(pool) < self.size:
+                config = get_config(user_agent, host_url)
+                token = await pow_solver.get_requirements_token(config)
+                pool.append((time.time(), config, token))
+                # Stop once the profile has been evicted while solving
+                pool = self.pools.get(profile)
+        except Exception as e:
+            logger.error(f"Failed to refill requirements pool: {e}")
+        finally:
+            self.refill_tasks.pop(profile, None)
+            self.update_gauge()
+
+    def update_gauge(self):
+        metrics.set("requirements_pool_size", sum(len(pool) for pool in self.pools.values()))
+
+
+requirements_pool = RequirementsPool(req_pool_size)
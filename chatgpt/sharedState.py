@@ -0,0 +1,115 @@
+import asyncio
+import os
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import utils.globals as globals
+from chatgpt.chatLimit import limit_tracker
+from chatgpt.tokenScheduler import token_scheduler
+from utils.Logger import logger
+from utils.config import shared_state, shared_sync_interval
+
+
+class SharedStateSync:
+    """Keeps this worker in step with the other workers sharing the SQLite state.
+
+    Every interval it publishes the token loads that changed locally, picks up the
+    loads of live workers, new rate limits and token list changes. Leases make sure
+    jobs such as the bulk refresh run in one worker only. The database work of each
+    pass runs in a thread, only applying its results touches the loop.
+
+    Without shared state the worker holds a lock on the data folder instead, so a
+    second process started on it (uvicorn --workers, gunicorn, a second instance)
+    refuses to start rather than silently keeping its own copy of the state.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.task = None
+        self.limit_id = 0
+        self.tokens_version = None
+        self.lock_file = None
+
+    def start(self):
+        if not shared_state:
+            self.lock_data_folder()
+        elif self.task is None:
+            self.tokens_version = globals.state.tokens_version()
+            self.task = asyncio.create_task(self.run())
+            logger.info(f"Shared state enabled, worker {self.worker_id}")
+
+    def lock_data_folder(self):
+        if fcntl is None or self.lock_file is not None:
+            return
+        lock_file = open(os.path.join(globals.DATA_FOLDER, "worker.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"Another process is already serving from {globals.DATA_FOLDER}. "
+                               f"Run several workers with WORKERS=<n> or set SHARED_STATE=true.")
+        self.lock_file = lock_file
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.error(f"Shared state sync failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sync(self):
+        changed = token_scheduler.pop_changed()
+        try:
+            remote, limits, tokens = await asyncio.to_thread(self.exchange, changed)
+        except Exception:
+            token_scheduler.changed.update(changed)
+            raise
+        token_scheduler.set_remote_loads(remote)
+        for limit_id, token, model, clear_time in limits:
+            limit_tracker.add(token, model, clear_time)
+            self.limit_id = limit_id
+        if tokens is not None:
+            self.tokens_version, token_list, error_token_list = tokens
+            globals.token_list[:] = token_list
+            globals.error_token_list[:] = error_token_list
+            token_scheduler.sync_tokens(globals.token_list, globals.error_token_list)
+
+    def exchange(self, changed):
+        """Runs in a thread: publishes local loads and reads what the other workers changed."""
+        state = globals.state
+        state.publish_loads(self.worker_id, changed)
+        # Workers that stopped heartbeating no longer count towards the loads
+        remote = state.remote_loads(self.worker_id, int(time.time() - 10 * self.interval))
+        limits = state.load_limits(self.limit_id)
+        tokens = None
+        tokens_version = state.tokens_version()
+        if tokens_version != self.tokens_version:
+            tokens = tokens_version, state.load_tokens(), state.load_error_tokens()
+        return remote, limits, tokens
+
+    def acquire_lease(self, name, ttl):
+        """Always true outside shared-state mode."""
+        return not shared_state or globals.state.acquire_lease(name, self.worker_id, ttl)
+
+    def release_lease(self, name):
+        if shared_state:
+            globals.state.release_lease(name, self.worker_id)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            await asyncio.to_thread(globals.state.drop_worker, self.worker_id)
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+shared_state_sync = SharedStateSync(shared_sync_interval)
@@ -0,0 +1,61 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """Parses an upstream event, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_value(value):
+    if value is None:
+        return "null"
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+def encode_delta(delta):
+    if not delta:
+        return "{}"
+    content = delta.get("content")
+    if type(content) is str:
+        if len(delta) == 1:
+            return '{"content": ' + encode_basestring_ascii(content) + '}'
+        if len(delta) == 2 and delta.get("role") == "assistant" and next(iter(delta)) == "role":
+            return '{"role": "assistant", "content": ' + encode_basestring_ascii(content) + '}'
+    return json.dumps(delta)
+
+
+class ChunkEncoder:
+    """Renders chat.completion.chunk SSE events for one response.
+
+    The envelope (id, object, created, model, system_fingerprint) is serialized once;
+    each chunk only escapes its delta, finish_reason and message/conversation ids.
+    The output is byte-for-byte what json.dumps with default settings produces for
+    the equivalent dict, including ensure_ascii escaping. orjson is not used here
+    because it has no ASCII-escaping mode.
+    """
+
+    def __init__(self, chat_id, created, model, system_fingerprint=None):
+        envelope = json.dumps({"id": chat_id, "object": "chat.completion.chunk", "created": created, "model": model})
+        self.head = "data: " + envelope[:-1] + ', "choices": [{"index": 0, "delta": '
+        self.tail = "}]"
+        if system_fingerprint:
+            self.tail += ', "system_fingerprint": ' + encode_value(system_fingerprint)
+
+    def encode(self, delta, finish_reason=None, message_id=None, conversation_id=None, with_ids=False, usage=None):
+        extra = ""
+        if with_ids:
+            extra = ', "message_id": ' + encode_value(message_id) + ', "conversation_id": ' + encode_value(conversation_id)
+        if usage is not None:
+            extra += ', "usage": ' + json.dumps(usage)
+        return (self.head + encode_delta(delta) + ', "logprobs": null, "finish_reason": ' + encode_value(finish_reason)
+                + self.tail + extra + "}\n\n")
@@ -0,0 +1,239 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+import utils.config as configs
+import utils.globals as globals
+from chatgpt.chatLimit import is_limited, limit_tracker
+from utils.Logger import logger
+from utils.metrics import metrics
+
+
+class TokenScheduler:
+    """Picks the least-loaded available token that is not rate limited for the requested model.
+
+    Available tokens are indexed by their in-flight request count. Each load bucket is a
+    list with a position map, so tokens move between buckets in O(1) as requests start
+    and finish, and adding or retiring a token never rescans the token list.
+
+    With max_inflight set, a request whose token is saturated waits in a FIFO queue until
+    a slot frees up, either on that token or, for pooled requests, on any eligible token.
+
+    In shared-state mode the loads other workers report are added to the local ones, so
+    every worker balances against the in-flight requests of the whole deployment.
+    """
+
+    def __init__(self, max_inflight=0, queue_timeout=30):
+        self.max_inflight = max_inflight
+        self.queue_timeout = queue_timeout
+        self.loads = {}
+        self.remote = {}
+        self.buckets = {}
+        self.positions = {}
+        self.in_flight = 0
+        self.cursor = 0
+        self.waiters = deque()
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.loads)
+
+    def __contains__(self, token):
+        return token in self.loads
+
+    def reset(self, tokens, error_tokens):
+        self.loads, self.buckets, self.positions = {}, {}, {}
+        self.in_flight = 0
+        error_tokens = set(error_tokens)
+        for token in tokens:
+            if token not in error_tokens:
+                self.add(token)
+        self.update_gauges()
+
+    def sync_tokens(self, tokens, error_tokens):
+        """Like reset, but keeps the loads of tokens that stay available."""
+        available = set(tokens) - set(error_tokens)
+        for token in list(self.loads):
+            if token not in available:
+                self.remove(token)
+        for token in tokens:
+            if token in available:
+                self.add(token)
+
+    def add(self, token):
+        if token and token not in self.loads:
+            self.loads[token] = 0
+            self._insert(token, self.remote.get(token, 0))
+            self.update_gauges()
+            self.dispatch(token)
+
+    def remove(self, token):
+        load = self.loads.pop(token, None)
+        limit_tracker.discard_token(token)
+        if load is not None:
+            self._delete(token, load + self.remote.get(token, 0))
+            self.in_flight -= load
+            self.changed.add(token)
+            self.update_gauges()
+
+    def level(self, token):
+        return self.loads[token] + self.remote.get(token, 0)
+
+    def _insert(self, token, load):
+        bucket = self.buckets.setdefault(load, [])
+        self.positions[token] = len(bucket)
+        bucket.append(token)
+
+    def _delete(self, token, load):
+        bucket = self.buckets[load]
+        index = self.positions.pop(token)
+        last = bucket.pop()
+        if last != token:
+            bucket[index] = last
+            self.positions[last] = index
+        if not bucket:
+            del self.buckets[load]
+
+    def _move(self, token, load):
+        self._delete(token, self.level(token))
+        self.loads[token] = load
+        self._insert(token, self.level(token))
+        self.changed.add(token)
+
+    def set_remote_loads(self, remote):
+        freed = []
+        for token in self.loads:
+            old, new = self.remote.get(token, 0), remote.get(token, 0)
+            if old != new:
+                self._delete(token, self.level(token))
+                self.remote[token] = new
+                self._insert(token, self.level(token))
+                if new < old:
+                    freed.append(token)
+        self.remote = {token: load for token, load in remote.items() if token in self.loads and load}
+        for token in freed:
+            self.dispatch(token)
+
+    def pop_changed(self):
+        """Local loads changed since the last call, for publishing to other workers."""
+        changed, self.changed = self.changed, set()
+        return {token: self.loads.get(token, 0) for token in changed}
+
+    def _candidates(self, bucket):
+        size = len(bucket)
+        if configs.random_token:
+            start = random.randrange(size)
+        else:
+            # Rotate through tokens with equal load
+            start = self.cursor % size
+            self.cursor += 1
+        return (bucket[(start + i) % size] for i in range(size))
+
+    def pick(self, model=None):
+        """Returns the token to use without reserving it; see acquire/release."""
+        skipped = 0
+        limited = limit_tracker.limited_tokens(model) if model else ()
+        for load in sorted(self.buckets):
+            for token in self._candidates(self.buckets[load]):
+                if token in limited:
+                    skipped += 1
+                    continue
+                self.report(token, load, skipped, model)
+                return token
+        if self.loads:
+            # Every token is limited for this model, let the limit check answer the request
+            token = min(self.loads, key=self.level)
+            metrics.inc("token_scheduler_all_limited")
+            self.report(token, self.level(token), skipped, model)
+            return token
+        return None
+
+    def saturated(self, token):
+        return bool(self.max_inflight) and token in self.loads and self.level(token) >= self.max_inflight
+
+    def reserve(self, token):
+        if token in self.loads:
+            self._move(token, self.loads[token] + 1)
+            self.in_flight += 1
+            self.update_gauges()
+
+    async def acquire(self, token, model=None, pooled=False):
+        """Reserves a slot on token, waiting in the queue while it is saturated.
+
+        Pooled requests accept whichever token frees up first, so the token returned
+        may differ from the one passed in.
+        """
+        if token not in self.loads or not self.saturated(token):
+            self.reserve(token)
+            return token
+
+        waiter = Waiter(asyncio.get_running_loop().create_future(), None if pooled else token, model)
+        self.waiters.append(waiter)
+        self.update_gauges()
+        start = time.time()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                return waiter.future.result()
+            metrics.inc("token_queue_timeouts")
+            raise HTTPException(status_code=429, detail="All tokens are busy, please try again later.")
+        except asyncio.CancelledError:
+            # A slot handed over right before cancellation would otherwise be lost
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            raise
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            metrics.observe("token_queue_wait", time.time() - start)
+            self.update_gauges()
+
+    def release(self, token):
+        if token in self.loads and self.loads[token] > 0:
+            self._move(token, self.loads[token] - 1)
+            self.in_flight -= 1
+            self.update_gauges()
+            self.dispatch(token)
+
+    def dispatch(self, token):
+        """Hands free slots of token to the oldest waiters that can use it."""
+        if not self.waiters:
+            return
+        for waiter in list(self.waiters):
+            if token not in self.loads or self.saturated(token):
+                break
+            if waiter.future.done():
+                continue
+            if waiter.token == token or (waiter.token is None and not (waiter.model and is_limited(token, waiter.model))):
+                self.waiters.remove(waiter)
+                self.reserve(token)
+                waiter.future.set_result(token)
+        self.update_gauges()
+
+    def report(self, token, load, skipped, model):
+        metrics.inc("token_scheduler_picks")
+        if skipped:
+            metrics.inc("token_scheduler_skipped_limited", skipped)
+        logger.info(f"Token scheduler: {token[:40]} for {model or 'any model'}, in-flight {load}, skipped {skipped} limited")
+
+    def update_gauges(self):
+        metrics.set("tokens_available", len(self.loads))
+        metrics.set("tokens_in_flight", self.in_flight)
+        metrics.set("token_queue_depth", len(self.waiters))
+
+
+class Waiter:
+    def __init__(self, future, token, model):
+        self.future = future
+        self.token = token
+        self.model = model
+
+
+token_scheduler = TokenScheduler(configs.token_max_inflight, configs.token_queue_timeout)
+token_scheduler.reset(globals.token_list, globals.error_token_list)
@@ -0,0 +1,44 @@
+import time
+from collections import OrderedDict
+
+from utils.config import upload_cache_size, upload_cache_ttl
+from utils.metrics import metrics
+
+
+class UploadCache:
+    """Remembers the file_meta of earlier uploads per account, keyed by a SHA-256 of the file.
+
+    Clients resend every image of the history on each turn; a hit reuses the
+    existing file-service:// pointer instead of uploading the bytes again.
+    Entries expire after ttl seconds and the least recently used are evicted
+    beyond size.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] >= self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            metrics.inc("upload_cache_misses")
+            return None
+        self.entries.move_to_end(key)
+        metrics.inc("upload_cache_hits")
+        return dict(entry[1])
+
+    def put(self, key, file_meta):
+        if self.size <= 0:
+            return
+        self.entries[key] = (time.time(), dict(file_meta))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        metrics.set("upload_cache_size", len(self.entries))
+
+
+upload_cache = UploadCache(upload_cache_size, upload_cache_ttl)
@@ -1,13 +1,12 @@
-import json
 import time
 
 from utils.Logger import logger
+from utils.store import json_store
 import utils.globals as globals
 
 
 def save_wss_map(wss_map):
-    with open(globals.WSS_MAP_FILE, "w") as f:
-        json.dump(wss_map, f, indent=4)
+    json_store.save(globals.WSS_MAP_FILE, wss_map)
 
 
 async def token2wss(token):
@@ -7,15 +7,15 @@ import uuid
 from fastapi import Request, HTTPException
 from fastapi.responses import RedirectResponse, StreamingResponse, Response
 from starlette.background import BackgroundTask
-from starlette.concurrency import run_in_threadpool
 
 import utils.globals as globals
 from app import app
 from chatgpt.authorization import verify_token, get_fp
-from chatgpt.proofofWork import get_answer_token, get_config, get_requirements_token
+from chatgpt.powSolver import pow_solver
+from chatgpt.requirementsPool import requirements_pool
 from gateway.chatgpt import chatgpt_html
 from gateway.reverseProxy import chatgpt_reverse_proxy, content_generator, get_real_req_token, headers_reject_list
-from utils.Client import Client
+from utils.Client import session_pool
 from utils.Logger import logger
 from utils.config import x_sign, turnstile_solver_url, chatgpt_base_url_list, no_sentinel
 
@@ -45,11 +45,9 @@ async def check_account(request: Request):
         check_account_info = json.loads(check_account_str)
         for key in check_account_info.get("accounts", {}).keys():
             account_id = check_account_info["accounts"][key]["account"]["account_id"]
-            globals.seed_map[token]["user_id"] = \
-            check_account_info["accounts"][key]["account"]["account_user_id"].split("__")[0]
+            globals.state.set_seed_user(token,
+                                        check_account_info["accounts"][key]["account"]["account_user_id"].split("__")[0])
             check_account_info["accounts"][key]["account"]["account_user_id"] = f"user-chatgpt__{account_id}"
-        with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-            json.dump(globals.seed_map, f, indent=4)
         return check_account_info
 
 
@@ -98,17 +96,7 @@ async def get_conversations(request: Request):
         limit = int(request.query_params.get("limit", 28))
         offset = int(request.query_params.get("offset", 0))
         is_archived = request.query_params.get("is_archived", None)
-        items = []
-        for conversation_id in globals.seed_map.get(token, {}).get("conversations", []):
-            conversation = globals.conversation_map.get(conversation_id, None)
-            if conversation:
-                if is_archived == "true":
-                    if conversation.get("is_archived", False):
-                        items.append(conversation)
-                else:
-                    if not conversation.get("is_archived", False):
-                        items.append(conversation)
-        items = items[int(offset):int(offset) + int(limit)]
+        items = await globals.state.list_conversations(token, is_archived == "true", offset, limit)
         conversations = {
             "items": items,
             "total": len(items),
@@ -131,18 +119,14 @@ async def update_conversation(request: Request, conversation_id: str):
     else:
         conversation_details_str = conversation_details_response.body.decode('utf-8')
         conversation_details = json.loads(conversation_details_str)
-        if conversation_id in globals.seed_map[token][
-            "conversations"] and conversation_id in globals.conversation_map:
-            globals.conversation_map[conversation_id]["title"] = conversation_details.get("title", None)
-            globals.conversation_map[conversation_id]["is_archived"] = conversation_details.get("is_archived",
-                                                                                                False)
-            globals.conversation_map[conversation_id]["conversation_template_id"] = conversation_details.get(
-                "conversation_template_id", None)
-            globals.conversation_map[conversation_id]["gizmo_id"] = conversation_details.get("gizmo_id", None)
-            globals.conversation_map[conversation_id]["async_status"] = conversation_details.get("async_status",
-                                                                                                 None)
-            with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.conversation_map, f, indent=4)
+        if await globals.state.get_conversation(token, conversation_id):
+            globals.state.update_conversation(conversation_id, {
+                "title": conversation_details.get("title", None),
+                "is_archived": conversation_details.get("is_archived", False),
+                "conversation_template_id": conversation_details.get("conversation_template_id", None),
+                "gizmo_id": conversation_details.get("gizmo_id", None),
+                "async_status": conversation_details.get("async_status", None)
+            })
         return conversation_details_response
 
 
@@ -154,17 +138,11 @@ async def patch_conversation(request: Request, conversation_id: str):
         return patch_response
     else:
         data = await request.json()
-        if conversation_id in globals.seed_map[token][
-            "conversations"] and conversation_id in globals.conversation_map:
+        if await globals.state.get_conversation(token, conversation_id):
             if not data.get("is_visible", True):
-                globals.conversation_map.pop(conversation_id)
-                globals.seed_map[token]["conversations"].remove(conversation_id)
-                with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-                    json.dump(globals.seed_map, f, indent=4)
+                globals.state.delete_conversation(token, conversation_id)
             else:
-                globals.conversation_map[conversation_id].update(data)
-            with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.conversation_map, f, indent=4)
+                globals.state.update_conversation(conversation_id, data)
         return patch_response
 
 
@@ -252,7 +230,7 @@ if no_sentinel:
         token = request.headers.get("Authorization", "").replace("Bearer ", "")
         req_token = await get_real_req_token(token)
         access_token = await verify_token(req_token)
-        fp = get_fp(req_token)
+        fp = await get_fp(req_token)
         proxy_url = fp.pop("proxy_url", None)
         impersonate = fp.pop("impersonate", "safari15_3")
         user_agent = fp.get("user-agent",
@@ -273,10 +251,9 @@ if no_sentinel:
             "oai-device-id": fp.get("oai-device-id", str(uuid.uuid4()))
         })
 
-        client = Client(proxy=proxy_url, impersonate=impersonate)
+        client = session_pool.client(proxy=proxy_url, impersonate=impersonate)
 
-        config = get_config(user_agent)
-        p = get_requirements_token(config)
+        config, p = await requirements_pool.get(user_agent, host_url)
         data = {'p': p}
         r = await client.post(f'{host_url}/backend-api/sentinel/chat-requirements', headers=headers, json=data,
                               timeout=10)
@@ -298,9 +275,7 @@ if no_sentinel:
         if proofofwork_required:
             proofofwork_diff = proofofwork.get("difficulty")
             proofofwork_seed = proofofwork.get("seed")
-            proof_token, solved = await run_in_threadpool(
-                get_answer_token, proofofwork_seed, proofofwork_diff, config
-            )
+            proof_token, solved = await pow_solver.get_answer_token(proofofwork_seed, proofofwork_diff, config)
             if not solved:
                 raise HTTPException(status_code=403, detail="Failed to solve proof of work")
         chat_token = resp.get('token')
@@ -10,7 +10,7 @@ from starlette.background import BackgroundTask
 
 import utils.globals as globals
 from chatgpt.authorization import verify_token, get_req_token, get_fp
-from utils.Client import Client
+from utils.Client import session_pool
 from utils.Logger import logger
 from utils.config import chatgpt_base_url_list
 
@@ -74,37 +74,19 @@ headers_reject_list = [
 
 
 async def get_real_req_token(token):
-    req_token = get_req_token(token)
+    req_token = await get_req_token(token)
     if len(req_token) == 45 or req_token.startswith("eyJhbGciOi"):
         return req_token
     else:
-        req_token = get_req_token(None, token)
+        req_token = await get_req_token(None, token)
         return req_token
 
 
-def save_conversation(token, conversation_id, title=None):
-    if conversation_id not in globals.conversation_map:
-        conversation_detail = {
-            "id": conversation_id,
-            "title": title,
-            "update_time": generate_current_time()
-        }
-        globals.conversation_map[conversation_id] = conversation_detail
-    else:
-        globals.conversation_map[conversation_id]["update_time"] = generate_current_time()
-        if title:
-            globals.conversation_map[conversation_id]["title"] = title
-    if conversation_id not in globals.seed_map[token]["conversations"]:
-        globals.seed_map[token]["conversations"].insert(0, conversation_id)
-    else:
-        globals.seed_map[token]["conversations"].remove(conversation_id)
-        globals.seed_map[token]["conversations"].insert(0, conversation_id)
-    with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.conversation_map, f, indent=4)
-    with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.seed_map, f, indent=4)
+async def save_conversation(token, conversation_id, title=None):
+    conversation = await globals.state.touch_conversation(token, conversation_id, generate_current_time(), title)
     if title:
         logger.info(f"Conversation ID: {conversation_id}, Title: {title}")
+    return conversation
 
 
 async def content_generator(r, token):
@@ -126,14 +108,13 @@ async def content_generator(r, token):
                     chunk_data = chunk_data.strip()
                     if conversation_id is None:
                         conversation_id = json.loads(chunk_data).get("conversation_id")
-                        save_conversation(token, conversation_id)
-                        title = globals.conversation_map[conversation_id].get("title")
+                        title = (await save_conversation(token, conversation_id)).get("title")
                     if title is None:
                         if "title" in chunk_data:
                             pass
                         title = json.loads(chunk_data).get("title")
                     if title:
-                        save_conversation(token, conversation_id, title)
+                        await save_conversation(token, conversation_id, title)
         except Exception as e:
             # logger.error(e)
             # logger.error(chunk.decode('utf-8'))
@@ -173,7 +154,7 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
 
         token = request.cookies.get("token", "")
         req_token = await get_real_req_token(token)
-        fp = get_fp(req_token)
+        fp = await get_fp(req_token)
         proxy_url = fp.pop("proxy_url", None)
         impersonate = fp.pop("impersonate", "safari15_3")
         user_agent = fp.get("user-agent")
@@ -205,7 +186,7 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
 
         data = await request.body()
 
-        client = Client(proxy=proxy_url, impersonate=impersonate)
+        client = session_pool.client(proxy=proxy_url, impersonate=impersonate)
         try:
             background = BackgroundTask(client.close)
             r = await client.request(request.method, f"{base_url}/{path}", params=params, headers=headers,
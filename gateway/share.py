@@ -11,7 +11,7 @@ import utils.globals as globals
 from app import app, security_scheme
 from chatgpt.authorization import get_fp, verify_token
 from gateway.reverseProxy import get_real_req_token
-from utils.Client import Client
+from utils.Client import session_pool
 from utils.Logger import logger
 from utils.config import proxy_url_list, chatgpt_base_url_list, authorization_list
 
@@ -43,20 +43,18 @@ async def get_seedtoken(request: Request, credentials: HTTPAuthorizationCredenti
         seed = params.get("seed")
 
         if seed:
-            if seed not in globals.seed_map:
+            seed_data = await globals.state.get_seed(seed)
+            if seed_data is None:
                 raise HTTPException(status_code=404, detail=f"Seed '{seed}' not found")
             return {
                 "status": "success",
                 "data": {
                     "seed": seed,
-                    "token": globals.seed_map[seed]["token"]
+                    "token": seed_data["token"]
                 }
             }
 
-        token_map = {
-            seed: data["token"]
-            for seed, data in globals.seed_map.items()
-        }
+        token_map = await globals.state.list_seeds()
         return {"status": "success", "data": token_map}
 
     except Exception as e:
@@ -71,16 +69,7 @@ async def set_seedtoken(request: Request, credentials: HTTPAuthorizationCredenti
     seed = data.get("seed")
     token = data.get("token")
 
-    if seed not in globals.seed_map:
-        globals.seed_map[seed] = {
-            "token": token,
-            "conversations": []
-        }
-    else:
-        globals.seed_map[seed]["token"] = token
-
-    with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.seed_map, f, indent=4)
+    globals.state.set_seed_token(seed, token)
 
     return {"status": "success", "message": "Token updated successfully"}
 
@@ -94,20 +83,14 @@ async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCrede
         seed = data.get("seed")
 
         if seed == "clear":
-            globals.seed_map.clear()
-            with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.seed_map, f, indent=4)
+            globals.state.clear_seeds()
             return {"status": "success", "message": "All seeds deleted successfully"}
 
         if not seed:
             raise HTTPException(status_code=400, detail="Missing required field: seed")
 
-        if seed not in globals.seed_map:
+        if not await globals.state.delete_seed(seed):
             raise HTTPException(status_code=404, detail=f"Seed '{seed}' not found")
-        del globals.seed_map[seed]
-
-        with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-            json.dump(globals.seed_map, f, indent=4)
 
         return {
             "status": "success",
@@ -122,12 +105,12 @@ async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCrede
 
 async def chatgpt_account_check(access_token):
     auth_info = {}
-    client = Client(proxy=random.choice(proxy_url_list) if proxy_url_list else None)
+    client = None
     try:
         host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
         req_token = await get_real_req_token(access_token)
         access_token = await verify_token(req_token)
-        fp = get_fp(req_token)
+        fp = await get_fp(req_token)
         proxy_url = fp.pop("proxy_url", None)
         impersonate = fp.pop("impersonate", "safari15_3")
 
@@ -135,7 +118,7 @@ async def chatgpt_account_check(access_token):
         headers.update({"authorization": f"Bearer {access_token}"})
         headers.update(fp)
 
-        client = Client(proxy=proxy_url, impersonate=impersonate)
+        client = session_pool.client(proxy=proxy_url, impersonate=impersonate)
         r = await client.get(f"{host_url}/backend-api/models?history_and_training_disabled=false", headers=headers,
                              timeout=10)
         if r.status_code != 200:
@@ -180,11 +163,12 @@ async def chatgpt_account_check(access_token):
         logger.error(f"chatgpt_account_check: {e}")
         return {}
     finally:
-        await client.close()
+        if client:
+            await client.close()
 
 
 async def chatgpt_refresh(refresh_token):
-    client = Client(proxy=random.choice(proxy_url_list) if proxy_url_list else None)
+    client = session_pool.client(proxy=random.choice(proxy_url_list) if proxy_url_list else None)
     try:
         data = {
             "client_id": "pdlLIX2Y72MIl2rhLhTE9VV9bN905kBh",
@@ -205,7 +189,8 @@ async def chatgpt_refresh(refresh_token):
         logger.error(f"chatgpt_refresh: {e}")
         return {}
     finally:
-        await client.close()
+        if client:
+            await client.close()
 
 
 @app.post("/auth/refresh")
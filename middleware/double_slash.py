@@ -0,0 +1,19 @@
+"""
+Double Slash Fix Middleware
+Collapses repeated slashes in the request path (//v1//chat -> /v1/chat)
+"""
+import re
+
+SLASHES = re.compile(r'/+')
+
+
+class DoubleSlashFixMiddleware:
+    """Pure ASGI middleware that normalizes the path in the scope before routing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket") and '//' in scope["path"]:
+            scope["path"] = SLASHES.sub('/', scope["path"])
+        await self.app(scope, receive, send)
@@ -1,6 +1,12 @@
-import random
+import asyncio
+import time
 
-from curl_cffi.requests import AsyncSession
+from curl_cffi import CurlError
+from curl_cffi.requests import AsyncSession, Cookies
+
+from utils.Logger import logger
+from utils.config import session_max_clients, session_stream_max_clients, session_idle_timeout
+from utils.metrics import metrics
 
 
 class Client:
@@ -54,3 +60,180 @@ class Client:
                 del self.session2
             except Exception:
                 pass
+
+
+class PooledSession:
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        self.refs = 0
+        self.failures = 0
+        self.last_used = time.time()
+
+
+class PooledClient:
+    """Client-compatible wrapper that borrows a shared session from a SessionPool.
+
+    Cookies are kept per borrower and cleared from the shared session after every
+    response, so accounts sharing a session never see each other's cookies. Streamed
+    requests go through a separate session, like Client.session2, so long-lived streams
+    cannot use up the handles short API calls need; close() aborts any stream the
+    borrower left open.
+    """
+
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.session = entry.session
+        self.stream_entry = None
+        self.streams = []
+        self.cookies = Cookies()
+
+    async def _request(self, method, *args, cookies=None, stream=False, **kwargs):
+        if self.entry is None:
+            raise RuntimeError("Client already closed")
+        entry = self.entry
+        if stream:
+            if self.stream_entry is None:
+                self.stream_entry = self.pool.acquire(self.entry.key[:-1] + (True,))
+            entry = self.stream_entry
+        session = entry.session
+        jar = Cookies(self.cookies)
+        if cookies:
+            jar.update(cookies)
+        try:
+            r = await session.request(method, *args, cookies=jar, stream=stream, **kwargs)
+        except CurlError:
+            entry.failures += 1
+            raise
+        finally:
+            session.cookies.clear()
+        entry.failures = 0
+        self.cookies.update(r.cookies)
+        if stream:
+            self.streams.append(r)
+        return r
+
+    async def post(self, *args, **kwargs):
+        return await self._request("POST", *args, **kwargs)
+
+    async def post_stream(self, *args, **kwargs):
+        return await self._request("POST", *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._request("GET", *args, **kwargs)
+
+    async def request(self, *args, **kwargs):
+        return await self._request(*args, **kwargs)
+
+    async def put(self, *args, **kwargs):
+        return await self._request("PUT", *args, **kwargs)
+
+    async def close(self):
+        streams, self.streams = self.streams, []
+        for r in streams:
+            # An unread stream keeps its curl handle busy until the transfer ends, stop it first
+            if r.quit_now is not None:
+                r.quit_now.set()
+            try:
+                await r.aclose()
+            except Exception:
+                pass
+        if self.stream_entry is not None:
+            self.pool.release(self.stream_entry)
+            self.stream_entry = None
+        if self.entry is not None:
+            self.pool.release(self.entry)
+            self.entry = None
+
+
+class SessionPool:
+    """Process-wide curl_cffi sessions keyed by (proxy, impersonate), reused across requests.
+
+    Each session keeps its connections alive and caps them at max_clients, or at
+    stream_max_clients for the sessions that carry streamed responses. Sessions idle
+    for longer than idle_timeout are closed, and sessions that keep failing at the
+    connection level are replaced.
+    """
+
+    max_failures = 3
+
+    def __init__(self, max_clients, stream_max_clients, idle_timeout):
+        self.max_clients = max_clients
+        self.stream_max_clients = stream_max_clients
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.janitor = None
+
+    def client(self, proxy=None, impersonate='safari15_3', timeout=15, verify=True):
+        return PooledClient(self, self.acquire((proxy, impersonate, timeout, verify, False)))
+
+    def acquire(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry.failures >= self.max_failures:
+            if entry is not None:
+                self.discard(entry)
+            proxy, impersonate, timeout, verify, streaming = key
+            session = AsyncSession(proxies={"http": proxy, "https": proxy}, timeout=timeout, impersonate=impersonate,
+                                   verify=verify,
+                                   max_clients=self.stream_max_clients if streaming else self.max_clients)
+            entry = self.entries[key] = PooledSession(key, session)
+            metrics.inc("http_sessions_created")
+            metrics.set("http_sessions", len(self.entries))
+        entry.refs += 1
+        entry.last_used = time.time()
+        if self.janitor is None:
+            self.janitor = asyncio.create_task(self.run_janitor())
+        return entry
+
+    def release(self, entry):
+        entry.refs -= 1
+        entry.last_used = time.time()
+        if entry.refs <= 0 and self.entries.get(entry.key) is not entry:
+            asyncio.create_task(self.close_entry(entry))
+
+    def discard(self, entry):
+        if self.entries.get(entry.key) is entry:
+            del self.entries[entry.key]
+            metrics.set("http_sessions", len(self.entries))
+        if entry.refs <= 0:
+            asyncio.create_task(self.close_entry(entry))
+
+    async def close_entry(self, entry):
+        try:
+            await entry.session.close()
+        except Exception:
+            pass
+        metrics.inc("http_sessions_closed")
+
+    async def run_janitor(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            try:
+                await self.check_sessions()
+            except Exception as e:
+                logger.error(f"Session pool check failed: {e}")
+
+    async def check_sessions(self):
+        now = time.time()
+        for entry in list(self.entries.values()):
+            if entry.refs > 0:
+                continue
+            if now - entry.last_used > self.idle_timeout:
+                self.discard(entry)
+            elif hasattr(entry.session, "upkeep"):
+                # Keeps idle connections warm and catches dead ones before a request does
+                codes = await entry.session.upkeep()
+                if any(codes):
+                    entry.failures = self.max_failures
+
+    async def close(self):
+        if self.janitor is not None:
+            self.janitor.cancel()
+            self.janitor = None
+        entries, self.entries = list(self.entries.values()), {}
+        for entry in entries:
+            await self.close_entry(entry)
+
+
+session_pool = SessionPool(session_max_clients, session_stream_max_clients, session_idle_timeout)
@@ -46,6 +46,31 @@ check_model = is_true(os.getenv('CHECK_MODEL', False))
 scheduled_refresh = is_true(os.getenv('SCHEDULED_REFRESH', False))
 random_token = is_true(os.getenv('RANDOM_TOKEN', True))
 oai_language = os.getenv('OAI_LANGUAGE', 'en-US')
+req_pool_size = int(os.getenv('REQ_POOL_SIZE', 4))
+session_max_clients = int(os.getenv('SESSION_MAX_CLIENTS', 64))
+session_stream_max_clients = int(os.getenv('SESSION_STREAM_MAX_CLIENTS', 256))
+session_idle_timeout = int(os.getenv('SESSION_IDLE_TIMEOUT', 300))
+token_max_inflight = int(os.getenv('TOKEN_MAX_INFLIGHT', 0))
+token_queue_timeout = int(os.getenv('TOKEN_QUEUE_TIMEOUT', 30))
+token_refresh_margin = int(os.getenv('TOKEN_REFRESH_MARGIN', 24 * 60 * 60))
+refresh_concurrency = int(os.getenv('REFRESH_CONCURRENCY', 4))
+refresh_window = int(os.getenv('REFRESH_WINDOW', 60 * 60))
+persist_interval = float(os.getenv('PERSIST_INTERVAL', 2))
+# uvicorn reads WEB_CONCURRENCY as its default worker count
+workers = int(os.getenv('WORKERS', os.getenv('WEB_CONCURRENCY', 1)))
+shared_state = is_true(os.getenv('SHARED_STATE', workers > 1))
+# Worker processes can only share state through the SQLite backend
+state_backend = 'sqlite' if shared_state else os.getenv('STATE_BACKEND', 'json').lower()
+shared_sync_interval = float(os.getenv('SHARED_SYNC_INTERVAL', 1))
+pow_workers = int(os.getenv('POW_WORKERS', max(1, (os.cpu_count() or 1) // workers)))
+token_cache_size = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+token_thread_threshold = int(os.getenv('TOKEN_THREAD_THRESHOLD', 32 * 1024))
+upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+upload_cache_size = int(os.getenv('UPLOAD_CACHE_SIZE', 1024))
+upload_cache_ttl = int(os.getenv('UPLOAD_CACHE_TTL', 60 * 60))
+stream_uploads = is_true(os.getenv('STREAM_UPLOADS', False))
+downscale_images = is_true(os.getenv('DOWNSCALE_IMAGES', False))
+upload_ready_timeout = float(os.getenv('UPLOAD_READY_TIMEOUT', 30))
 
 authorization_list = authorization.split(',') if authorization else []
 chatgpt_base_url_list = chatgpt_base_url.split(',') if chatgpt_base_url else []
@@ -86,6 +111,28 @@ logger.info("CHECK_MODEL:       " + str(check_model))
 logger.info("SCHEDULED_REFRESH: " + str(scheduled_refresh))
 logger.info("RANDOM_TOKEN:      " + str(random_token))
 logger.info("OAI_LANGUAGE:      " + str(oai_language))
+logger.info("POW_WORKERS:       " + str(pow_workers))
+logger.info("REQ_POOL_SIZE:     " + str(req_pool_size))
+logger.info("SESSION_MAX_CLIENTS: " + str(session_max_clients))
+logger.info("SESSION_STREAM_MAX_CLIENTS: " + str(session_stream_max_clients))
+logger.info("SESSION_IDLE_TIMEOUT: " + str(session_idle_timeout))
+logger.info("TOKEN_MAX_INFLIGHT: " + str(token_max_inflight))
+logger.info("TOKEN_QUEUE_TIMEOUT: " + str(token_queue_timeout))
+logger.info("TOKEN_REFRESH_MARGIN: " + str(token_refresh_margin))
+logger.info("REFRESH_CONCURRENCY: " + str(refresh_concurrency))
+logger.info("REFRESH_WINDOW:    " + str(refresh_window))
+logger.info("PERSIST_INTERVAL:  " + str(persist_interval))
+logger.info("WORKERS:           " + str(workers))
+logger.info("SHARED_STATE:      " + str(shared_state))
+logger.info("STATE_BACKEND:     " + str(state_backend))
+logger.info("TOKEN_CACHE_SIZE:  " + str(token_cache_size))
+logger.info("TOKEN_THREAD_THRESHOLD: " + str(token_thread_threshold))
+logger.info("UPLOAD_CONCURRENCY: " + str(upload_concurrency))
+logger.info("UPLOAD_CACHE_SIZE: " + str(upload_cache_size))
+logger.info("UPLOAD_CACHE_TTL:  " + str(upload_cache_ttl))
+logger.info("STREAM_UPLOADS:    " + str(stream_uploads))
+logger.info("DOWNSCALE_IMAGES:  " + str(downscale_images))
+logger.info("UPLOAD_READY_TIMEOUT: " + str(upload_ready_timeout))
 logger.info("------------------------- Gateway --------------------------")
 logger.info("ENABLE_GATEWAY:    " + str(enable_gateway))
 logger.info("AUTO_SEED:         " + str(auto_seed))
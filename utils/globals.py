@@ -5,6 +5,7 @@ from pathlib import Path
 
 import utils.config as configs
 from utils.Logger import logger
+from utils.state import JsonBackend, SqliteBackend
 
 # Use exe-relative paths when bundled
 def get_data_folder():
@@ -24,15 +25,12 @@ WSS_MAP_FILE = os.path.join(DATA_FOLDER, "wss_map.json")
 FP_FILE = os.path.join(DATA_FOLDER, "fp_map.json")
 SEED_MAP_FILE = os.path.join(DATA_FOLDER, "seed_map.json")
 CONVERSATION_MAP_FILE = os.path.join(DATA_FOLDER, "conversation_map.json")
+STATE_DB_FILE = os.path.join(DATA_FOLDER, "state.db")
 
-count = 0
 token_list = []
 error_token_list = []
 refresh_map = {}
 wss_map = {}
-fp_map = {}
-seed_map = {}
-conversation_map = {}
 impersonate_list = [
     "chrome99",
     "chrome100",
@@ -51,14 +49,17 @@ impersonate_list = [
 if not os.path.exists(DATA_FOLDER):
     os.makedirs(DATA_FOLDER)
 
-if os.path.exists(REFRESH_MAP_FILE):
-    with open(REFRESH_MAP_FILE, "r") as f:
-        try:
-            refresh_map = json.load(f)
-        except:
-            refresh_map = {}
+if configs.state_backend == "sqlite":
+    state = SqliteBackend(STATE_DB_FILE)
+    if not state.is_imported():
+        state.import_json(JsonBackend(TOKENS_FILE, ERROR_TOKENS_FILE, REFRESH_MAP_FILE, FP_FILE, SEED_MAP_FILE,
+                                      CONVERSATION_MAP_FILE))
 else:
-    refresh_map = {}
+    state = JsonBackend(TOKENS_FILE, ERROR_TOKENS_FILE, REFRESH_MAP_FILE, FP_FILE, SEED_MAP_FILE, CONVERSATION_MAP_FILE)
+
+refresh_map = state.load_refresh_map()
+token_list = state.load_tokens()
+error_token_list = state.load_error_tokens()
 
 if os.path.exists(WSS_MAP_FILE):
     with open(WSS_MAP_FILE, "r") as f:
@@ -69,51 +70,6 @@ if os.path.exists(WSS_MAP_FILE):
 else:
     wss_map = {}
 
-if os.path.exists(FP_FILE):
-    with open(FP_FILE, "r", encoding="utf-8") as f:
-        try:
-            fp_map = json.load(f)
-        except:
-            fp_map = {}
-else:
-    fp_map = {}
-
-if os.path.exists(SEED_MAP_FILE):
-    with open(SEED_MAP_FILE, "r") as f:
-        try:
-            seed_map = json.load(f)
-        except:
-            seed_map = {}
-else:
-    seed_map = {}
-
-if os.path.exists(CONVERSATION_MAP_FILE):
-    with open(CONVERSATION_MAP_FILE, "r") as f:
-        try:
-            conversation_map = json.load(f)
-        except:
-            conversation_map = {}
-else:
-    conversation_map = {}
-
-if os.path.exists(TOKENS_FILE):
-    with open(TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                token_list.append(line.strip())
-else:
-    with open(TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
-
-if os.path.exists(ERROR_TOKENS_FILE):
-    with open(ERROR_TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                error_token_list.append(line.strip())
-else:
-    with open(ERROR_TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
-
 if token_list:
     logger.info(f"Token list count: {len(token_list)}, Error token list count: {len(error_token_list)}")
     logger.info("-" * 60)
@@ -0,0 +1,38 @@
+import time
+
+
+class Metrics:
+    """Process-local counters, gauges and timing summaries exposed on the /metrics endpoint."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        summary = self.summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+
+    def snapshot(self):
+        summaries = {
+            name: dict(summary, avg=summary["sum"] / summary["count"] if summary["count"] else 0.0)
+            for name, summary in self.summaries.items()
+        }
+        return {
+            "uptime": int(time.time() - self.started),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "summaries": summaries,
+        }
+
+
+metrics = Metrics()
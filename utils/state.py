@@ -0,0 +1,564 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from utils.Logger import logger
+from utils.store import json_store
+
+
+def load_json(path):
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except:
+                return {}
+    return {}
+
+
+def load_lines(path):
+    lines = []
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip() and not line.startswith("#"):
+                    lines.append(line.strip())
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            pass
+    return lines
+
+
+class StateBackend(ABC):
+    """Storage for tokens, the refresh cache, fingerprints, seeds and conversations.
+
+    Both backends return the same shapes, those of the original JSON files:
+    get_seed gives {"token", "conversations"[, "user_id"]} with the conversation ids
+    most recently touched first, list_seeds gives {seed: token} in creation order,
+    and list_conversations pages through a seed's conversations in that same
+    most-recently-touched-first order. Lookups that may hit the disk are coroutines;
+    writes return at once and may be persisted later.
+    """
+
+    @abstractmethod
+    def load_tokens(self):
+        pass
+
+    @abstractmethod
+    def add_token(self, token):
+        pass
+
+    @abstractmethod
+    def clear_tokens(self):
+        pass
+
+    @abstractmethod
+    def load_error_tokens(self):
+        pass
+
+    @abstractmethod
+    def add_error_token(self, token):
+        pass
+
+    @abstractmethod
+    def load_refresh_map(self):
+        pass
+
+    @abstractmethod
+    def save_refresh(self, refresh_map, refresh_tokens):
+        pass
+
+    @abstractmethod
+    async def get_fp(self, token):
+        pass
+
+    @abstractmethod
+    def set_fp(self, token, fp):
+        pass
+
+    @abstractmethod
+    async def get_seed(self, seed):
+        pass
+
+    @abstractmethod
+    async def list_seeds(self):
+        pass
+
+    @abstractmethod
+    def set_seed_token(self, seed, token):
+        pass
+
+    @abstractmethod
+    def set_seed_user(self, seed, user_id):
+        pass
+
+    @abstractmethod
+    async def delete_seed(self, seed):
+        pass
+
+    @abstractmethod
+    def clear_seeds(self):
+        pass
+
+    @abstractmethod
+    async def get_conversation(self, seed, conversation_id):
+        pass
+
+    @abstractmethod
+    async def list_conversations(self, seed, is_archived, offset, limit):
+        pass
+
+    @abstractmethod
+    async def touch_conversation(self, seed, conversation_id, update_time, title=None):
+        pass
+
+    @abstractmethod
+    def update_conversation(self, conversation_id, fields):
+        pass
+
+    @abstractmethod
+    def delete_conversation(self, seed, conversation_id):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonBackend(StateBackend):
+    """The original layout: everything in memory, persisted to JSON/text files in data/."""
+
+    def __init__(self, tokens_file, error_tokens_file, refresh_map_file, fp_file, seed_map_file,
+                 conversation_map_file):
+        self.tokens_file = tokens_file
+        self.error_tokens_file = error_tokens_file
+        self.refresh_map_file = refresh_map_file
+        self.fp_file = fp_file
+        self.seed_map_file = seed_map_file
+        self.conversation_map_file = conversation_map_file
+        self.fp_map = load_json(fp_file)
+        self.seed_map = load_json(seed_map_file)
+        self.conversation_map = load_json(conversation_map_file)
+
+    def load_tokens(self):
+        return load_lines(self.tokens_file)
+
+    def add_token(self, token):
+        with open(self.tokens_file, "a", encoding="utf-8") as f:
+            f.write(token + "\n")
+
+    def clear_tokens(self):
+        with open(self.tokens_file, "w", encoding="utf-8") as f:
+            pass
+
+    def load_error_tokens(self):
+        return load_lines(self.error_tokens_file)
+
+    def add_error_token(self, token):
+        with open(self.error_tokens_file, "a", encoding="utf-8") as f:
+            f.write(token + "\n")
+
+    def load_refresh_map(self):
+        return load_json(self.refresh_map_file)
+
+    def save_refresh(self, refresh_map, refresh_tokens):
+        json_store.save(self.refresh_map_file, refresh_map)
+
+    async def get_fp(self, token):
+        return self.fp_map.get(token, {})
+
+    def set_fp(self, token, fp):
+        self.fp_map[token] = fp
+        json_store.save(self.fp_file, self.fp_map)
+
+    async def get_seed(self, seed):
+        return self.seed_map.get(seed)
+
+    async def list_seeds(self):
+        return {seed: data["token"] for seed, data in self.seed_map.items()}
+
+    def set_seed_token(self, seed, token):
+        if seed not in self.seed_map:
+            self.seed_map[seed] = {"token": token, "conversations": []}
+        else:
+            self.seed_map[seed]["token"] = token
+        json_store.save(self.seed_map_file, self.seed_map)
+
+    def set_seed_user(self, seed, user_id):
+        self.seed_map[seed]["user_id"] = user_id
+        json_store.save(self.seed_map_file, self.seed_map)
+
+    async def delete_seed(self, seed):
+        if self.seed_map.pop(seed, None) is None:
+            return False
+        json_store.save(self.seed_map_file, self.seed_map)
+        return True
+
+    def clear_seeds(self):
+        self.seed_map.clear()
+        json_store.save(self.seed_map_file, self.seed_map)
+
+    async def get_conversation(self, seed, conversation_id):
+        if conversation_id in self.seed_map.get(seed, {}).get("conversations", []):
+            return self.conversation_map.get(conversation_id)
+        return None
+
+    async def list_conversations(self, seed, is_archived, offset, limit):
+        items = []
+        for conversation_id in self.seed_map.get(seed, {}).get("conversations", []):
+            conversation = self.conversation_map.get(conversation_id, None)
+            if conversation and conversation.get("is_archived", False) == is_archived:
+                items.append(conversation)
+        return items[offset:offset + limit]
+
+    async def touch_conversation(self, seed, conversation_id, update_time, title=None):
+        if conversation_id not in self.conversation_map:
+            self.conversation_map[conversation_id] = {"id": conversation_id, "title": title, "update_time": update_time}
+        else:
+            self.conversation_map[conversation_id]["update_time"] = update_time
+            if title:
+                self.conversation_map[conversation_id]["title"] = title
+        conversations = self.seed_map[seed]["conversations"]
+        if conversation_id in conversations:
+            conversations.remove(conversation_id)
+        conversations.insert(0, conversation_id)
+        json_store.save(self.conversation_map_file, self.conversation_map)
+        json_store.save(self.seed_map_file, self.seed_map)
+        return self.conversation_map[conversation_id]
+
+    def update_conversation(self, conversation_id, fields):
+        self.conversation_map[conversation_id].update(fields)
+        json_store.save(self.conversation_map_file, self.conversation_map)
+
+    def delete_conversation(self, seed, conversation_id):
+        self.conversation_map.pop(conversation_id, None)
+        self.seed_map[seed]["conversations"].remove(conversation_id)
+        json_store.save(self.conversation_map_file, self.conversation_map)
+        json_store.save(self.seed_map_file, self.seed_map)
+
+
+class SqliteBackend(StateBackend):
+    """Row-per-record storage in a SQLite database running in WAL mode.
+
+    Writes whose result nobody waits for are queued to a writer thread so handlers
+    never block on the database for them; reads first wait for the queued writes,
+    so they always see them, and the lookups run on a worker thread for the same
+    reason. A seed's conversations are kept in rowid order, touching one moves it
+    to the end, which is how the JSON seed list's most-recent-first order is kept.
+    """
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE IF NOT EXISTS tokens (token TEXT PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS error_tokens (token TEXT PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS refresh (refresh_token TEXT PRIMARY KEY, access_token TEXT, "
+        "timestamp INTEGER, expires INTEGER)",
+        "CREATE TABLE IF NOT EXISTS fingerprints (token TEXT PRIMARY KEY, fp TEXT)",
+        "CREATE TABLE IF NOT EXISTS seeds (seed TEXT PRIMARY KEY, token TEXT, user_id TEXT)",
+        "CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, seed TEXT, update_time TEXT, "
+        "is_archived INTEGER NOT NULL DEFAULT 0, data TEXT)",
+        "CREATE INDEX IF NOT EXISTS conversations_seed ON conversations (seed, is_archived)",
+        "CREATE INDEX IF NOT EXISTS conversations_update_time ON conversations (update_time)",
+        "CREATE TABLE IF NOT EXISTS limits (id INTEGER PRIMARY KEY AUTOINCREMENT, token TEXT, model TEXT, "
+        "clear_time INTEGER)",
+        "CREATE INDEX IF NOT EXISTS limits_clear_time ON limits (clear_time)",
+        "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat INTEGER)",
+        "CREATE TABLE IF NOT EXISTS token_loads (worker TEXT, token TEXT, load INTEGER, PRIMARY KEY (worker, token))",
+        "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires INTEGER)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            for statement in self.schema:
+                self.conn.execute(statement)
+        self.writes = queue.Queue()
+        self.writer = None
+
+    def query(self, sql, params=()):
+        self.writes.join()
+        return self.fetch(sql, params)
+
+    async def read(self, func, *args):
+        """Runs a lookup on a worker thread, so the event loop never waits on the writer."""
+        return await asyncio.to_thread(func, *args)
+
+    def fetch(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).rowcount
+
+    def execute_many(self, sql, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+    def submit(self, func, *args):
+        """Queues a write for the writer thread."""
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.run_writes, name="sqlite-writer", daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+        self.writes.put((func, args))
+
+    def run_writes(self):
+        while True:
+            item = self.writes.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+            except Exception as e:
+                logger.error(f"Failed to write to {self.path}: {e}")
+            finally:
+                self.writes.task_done()
+
+    def close(self):
+        if self.writer is not None:
+            self.writes.put(None)
+            if self.writer is not threading.current_thread():
+                self.writer.join()
+            self.writer = None
+
+    def is_imported(self):
+        return bool(self.query("SELECT 1 FROM meta WHERE key = 'imported'"))
+
+    def import_json(self, source):
+        """One-shot copy of a JsonBackend's data into the database."""
+        if self.is_imported():
+            return
+        seed_rows = []
+        conversation_rows = []
+        for seed, data in source.seed_map.items():
+            seed_rows.append((seed, data.get("token"), data.get("user_id")))
+            # Oldest first, so rowid order matches the seed list
+            for conversation_id in reversed(data.get("conversations", [])):
+                conversation = source.conversation_map.get(conversation_id)
+                if conversation:
+                    conversation_rows.append(self.conversation_row(seed, conversation))
+        with self.lock, self.conn:
+            # Workers starting together must not import twice
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchall():
+                return
+            self.conn.executemany("INSERT OR IGNORE INTO tokens (token) VALUES (?)",
+                                  [(token,) for token in source.load_tokens()])
+            self.conn.executemany("INSERT OR IGNORE INTO error_tokens (token) VALUES (?)",
+                                  [(token,) for token in source.load_error_tokens()])
+            self.conn.executemany("INSERT OR REPLACE INTO refresh VALUES (?, ?, ?, ?)",
+                                  [self.refresh_row(refresh_token, entry)
+                                   for refresh_token, entry in source.load_refresh_map().items()])
+            self.conn.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?)",
+                                  [(token, json.dumps(fp)) for token, fp in source.fp_map.items()])
+            self.conn.executemany("INSERT OR REPLACE INTO seeds VALUES (?, ?, ?)", seed_rows)
+            self.conn.executemany("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)", conversation_rows)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('imported', datetime('now'))")
+            self.bump_tokens_version()
+        logger.info(f"Imported {len(seed_rows)} seeds and {len(conversation_rows)} conversations into {self.path}")
+
+    @staticmethod
+    def refresh_row(refresh_token, entry):
+        return refresh_token, entry.get("token"), entry.get("timestamp"), entry.get("expires")
+
+    @staticmethod
+    def conversation_row(seed, conversation):
+        return (conversation["id"], seed, conversation.get("update_time"),
+                int(bool(conversation.get("is_archived", False))), json.dumps(conversation))
+
+    def load_tokens(self):
+        return [row[0] for row in self.query("SELECT token FROM tokens ORDER BY rowid")]
+
+    def add_token(self, token):
+        self.submit(self.change_tokens, "INSERT OR IGNORE INTO tokens (token) VALUES (?)", (token,))
+
+    def clear_tokens(self):
+        self.submit(self.change_tokens, "DELETE FROM tokens")
+
+    def load_error_tokens(self):
+        return [row[0] for row in self.query("SELECT token FROM error_tokens ORDER BY rowid")]
+
+    def add_error_token(self, token):
+        self.submit(self.change_tokens, "INSERT OR IGNORE INTO error_tokens (token) VALUES (?)", (token,))
+
+    def load_refresh_map(self):
+        refresh_map = {}
+        for refresh_token, access_token, timestamp, expires in self.query("SELECT * FROM refresh"):
+            refresh_map[refresh_token] = {"token": access_token, "timestamp": timestamp}
+            if expires:
+                refresh_map[refresh_token]["expires"] = expires
+        return refresh_map
+
+    def save_refresh(self, refresh_map, refresh_tokens):
+        rows = [self.refresh_row(refresh_token, refresh_map[refresh_token])
+                for refresh_token in refresh_tokens if refresh_token in refresh_map]
+        self.submit(self.execute_many, "INSERT OR REPLACE INTO refresh VALUES (?, ?, ?, ?)", rows)
+
+    def get_refresh(self, refresh_token):
+        # Only looks for other workers' renewals, ours are already in refresh_map
+        rows = self.fetch("SELECT access_token, timestamp, expires FROM refresh WHERE refresh_token = ?",
+                          (refresh_token,))
+        if not rows:
+            return None
+        access_token, timestamp, expires = rows[0]
+        entry = {"token": access_token, "timestamp": timestamp}
+        if expires:
+            entry["expires"] = expires
+        return entry
+
+    async def get_fp(self, token):
+        rows = await self.read(self.query, "SELECT fp FROM fingerprints WHERE token = ?", (token,))
+        return json.loads(rows[0][0]) if rows else {}
+
+    def set_fp(self, token, fp):
+        self.submit(self.execute, "INSERT OR REPLACE INTO fingerprints VALUES (?, ?)", (token, json.dumps(fp)))
+
+    async def get_seed(self, seed):
+        return await self.read(self._get_seed, seed)
+
+    def _get_seed(self, seed):
+        self.writes.join()
+        with self.lock:
+            rows = self.fetch("SELECT token, user_id FROM seeds WHERE seed = ?", (seed,))
+            if not rows:
+                return None
+            token, user_id = rows[0]
+            conversations = self.fetch("SELECT id FROM conversations WHERE seed = ? ORDER BY rowid DESC", (seed,))
+        data = {"token": token, "conversations": [row[0] for row in conversations]}
+        if user_id:
+            data["user_id"] = user_id
+        return data
+
+    async def list_seeds(self):
+        return dict(await self.read(self.query, "SELECT seed, token FROM seeds ORDER BY rowid"))
+
+    def set_seed_token(self, seed, token):
+        self.submit(self.execute, "INSERT INTO seeds (seed, token) VALUES (?, ?) "
+                                  "ON CONFLICT (seed) DO UPDATE SET token = excluded.token", (seed, token))
+
+    def set_seed_user(self, seed, user_id):
+        self.submit(self.execute, "UPDATE seeds SET user_id = ? WHERE seed = ?", (user_id, seed))
+
+    async def delete_seed(self, seed):
+        return await self.read(self._delete_seed, seed)
+
+    def _delete_seed(self, seed):
+        self.writes.join()
+        return self.execute("DELETE FROM seeds WHERE seed = ?", (seed,)) > 0
+
+    def clear_seeds(self):
+        self.submit(self.execute, "DELETE FROM seeds")
+
+    async def get_conversation(self, seed, conversation_id):
+        rows = await self.read(self.query, "SELECT data FROM conversations WHERE id = ? AND seed = ?", (conversation_id, seed))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def list_conversations(self, seed, is_archived, offset, limit):
+        rows = await self.read(self.query, "SELECT data FROM conversations WHERE seed = ? AND is_archived = ? "
+                               "ORDER BY rowid DESC LIMIT ? OFFSET ?", (seed, int(is_archived), limit, offset))
+        return [json.loads(row[0]) for row in rows]
+
+    async def touch_conversation(self, seed, conversation_id, update_time, title=None):
+        return await self.read(self._touch_conversation, seed, conversation_id, update_time, title)
+
+    def _touch_conversation(self, seed, conversation_id, update_time, title):
+        self.writes.join()
+        with self.lock:
+            rows = self.fetch("SELECT data FROM conversations WHERE id = ?", (conversation_id,))
+            if rows:
+                conversation = json.loads(rows[0][0])
+                conversation["update_time"] = update_time
+                if title:
+                    conversation["title"] = title
+            else:
+                conversation = {"id": conversation_id, "title": title, "update_time": update_time}
+            # REPLACE gives the row a new rowid, moving it to the front of the seed's list
+            self.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)",
+                         self.conversation_row(seed, conversation))
+        return conversation
+
+    def update_conversation(self, conversation_id, fields):
+        self.submit(self._update_conversation, conversation_id, dict(fields))
+
+    def _update_conversation(self, conversation_id, fields):
+        with self.lock:
+            rows = self.fetch("SELECT data FROM conversations WHERE id = ?", (conversation_id,))
+            if not rows:
+                return
+            conversation = json.loads(rows[0][0])
+            conversation.update(fields)
+            # UPDATE keeps the rowid, so the conversation keeps its place like in the JSON backend
+            self.execute("UPDATE conversations SET update_time = ?, is_archived = ?, data = ? WHERE id = ?",
+                         (conversation.get("update_time"), int(bool(conversation.get("is_archived", False))),
+                          json.dumps(conversation), conversation_id))
+
+    def delete_conversation(self, seed, conversation_id):
+        self.submit(self.execute, "DELETE FROM conversations WHERE id = ? AND seed = ?", (conversation_id, seed))
+
+    # Coordination between worker processes sharing the database, see chatgpt/sharedState.py
+
+    def change_tokens(self, sql, params=()):
+        """Changes the token or error token list and bumps tokens_version in the same transaction."""
+        with self.lock, self.conn:
+            if self.conn.execute(sql, params).rowcount:
+                self.bump_tokens_version()
+
+    def bump_tokens_version(self):
+        self.conn.execute("INSERT INTO meta VALUES ('tokens_version', 1) "
+                          "ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+    def tokens_version(self):
+        rows = self.query("SELECT value FROM meta WHERE key = 'tokens_version'")
+        return int(rows[0][0]) if rows else 0
+
+    def add_limit(self, token, model, clear_time):
+        self.submit(self._add_limit, token, model, clear_time)
+
+    def _add_limit(self, token, model, clear_time):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM limits WHERE clear_time <= ?", (int(time.time()),))
+            self.conn.execute("INSERT INTO limits (token, model, clear_time) VALUES (?, ?, ?)",
+                              (token, model, clear_time))
+
+    def load_limits(self, after_id):
+        now = int(time.time())
+        return self.query("SELECT id, token, model, clear_time FROM limits WHERE id > ? AND clear_time > ? "
+                          "ORDER BY id", (after_id, now))
+
+    def publish_loads(self, worker, loads):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (worker, int(time.time())))
+            self.conn.executemany("DELETE FROM token_loads WHERE worker = ? AND token = ?",
+                                  [(worker, token) for token, load in loads.items() if not load])
+            self.conn.executemany("INSERT OR REPLACE INTO token_loads VALUES (?, ?, ?)",
+                                  [(worker, token, load) for token, load in loads.items() if load])
+
+    def remote_loads(self, worker, alive_after):
+        return dict(self.query("SELECT token, SUM(load) FROM token_loads JOIN workers USING (worker) "
+                               "WHERE worker != ? AND heartbeat >= ? GROUP BY token", (worker, alive_after)))
+
+    def drop_worker(self, worker):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM token_loads WHERE worker = ?", (worker,))
+            self.conn.execute("DELETE FROM workers WHERE worker = ?", (worker,))
+
+    def acquire_lease(self, name, owner, ttl):
+        now = int(time.time())
+        return self.execute("INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE "
+                            "SET owner = excluded.owner, expires = excluded.expires "
+                            "WHERE leases.owner = excluded.owner OR leases.expires <= ?",
+                            (name, owner, now + ttl, now)) > 0
+
+    def release_lease(self, name, owner):
+        self.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
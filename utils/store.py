@@ -0,0 +1,122 @@
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import os
+import threading
+
+from utils.Logger import logger
+from utils.config import persist_interval
+from utils.metrics import metrics
+
+
+class JsonStore:
+    """Write-behind persistence for the JSON state maps.
+
+    save() only marks a file dirty; a worker thread writes the latest version of
+    every dirty file once per interval (temp file + rename), so any number of
+    mutations in between cost a single write and handlers never touch the disk.
+    The maps are live objects the event loop keeps mutating, so each pass first
+    copies the dirty ones on the loop and only serializes the copies on the thread.
+    """
+
+    def __init__(self, interval):
+        self.interval = max(0.1, interval)
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.loop = None
+
+    def save(self, path, data):
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        with self.lock:
+            self.dirty[path] = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="json-store", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+        if not dirty:
+            return
+        snapshots = self.snapshot(dirty)
+        if snapshots is None:
+            # Stopping while the loop is busy, close() writes them from its own thread
+            with self.lock:
+                for path, data in dirty.items():
+                    self.dirty.setdefault(path, data)
+            return
+        for path, data in snapshots.items():
+            try:
+                self.write(path, data)
+                metrics.inc("store_writes")
+            except Exception as e:
+                logger.error(f"Failed to write {path}: {e}")
+
+    def snapshot(self, dirty):
+        loop = self.loop
+        on_loop = loop is None or loop.is_closed() or not loop.is_running()
+        if not on_loop:
+            try:
+                on_loop = asyncio.get_running_loop() is loop
+            except RuntimeError:
+                pass
+        if on_loop:
+            return {path: copy_state(data) for path, data in dirty.items()}
+
+        future = concurrent.futures.Future()
+
+        def take():
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result({path: copy_state(data) for path, data in dirty.items()})
+                except Exception as e:
+                    future.set_exception(e)
+
+        loop.call_soon_threadsafe(take)
+        while not self.stopped.is_set():
+            try:
+                return future.result(timeout=self.interval)
+            except concurrent.futures.TimeoutError:
+                continue
+        if future.cancel():
+            return None
+        return future.result()
+
+    @staticmethod
+    def write(path, data):
+        content = json.dumps(data, indent=4)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+
+def copy_state(data):
+    """Copies the dicts and lists of a JSON-compatible map, sharing the immutable leaves."""
+    if isinstance(data, dict):
+        return {key: copy_state(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [copy_state(value) for value in data]
+    return data
+
+
+json_store = JsonStore(persist_interval)